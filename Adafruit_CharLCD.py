@@ -6,6 +6,8 @@
 # LiquidCrystal - https://github.com/arduino/Arduino/blob/master/libraries/LiquidCrystal/LiquidCrystal.cpp
 #
 
+import charset
+import mcp23008
 from time import sleep
 
 class Adafruit_CharLCD(object):
@@ -52,6 +54,8 @@ class Adafruit_CharLCD(object):
     LCD_5x10DOTS                 = 0x04
     LCD_5x8DOTS                 = 0x00
 
+    row_offsets = [ 0x00, 0x40, 0x14, 0x54 ]
+
 
 
     def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22]):
@@ -70,27 +74,42 @@ class Adafruit_CharLCD(object):
         self.displaymode =  self.LCD_ENTRYLEFT | self.LCD_ENTRYSHIFTDECREMENT
         self.write4bits(self.LCD_ENTRYMODESET | self.displaymode) #  set the entry mode
 
+        self.numcols = 16
+        self.numlines = 2
+        self.codec = charset.Codec()
+        self.glyphs = charset.GlyphCache()
         self.clear()
 
 
     def begin(self, cols, lines):
 
+        self.numcols = cols
         if (lines > 1):
                 self.numlines = lines
                 self.displayfunction |= self.LCD_2LINE
                 self.currline = 0
+        self.clearShadow()
+
+
+    def clearShadow(self):
+        """ Resets the shadow copy of the screen to blank, cursor at 0, 0 """
+
+        self.shadow = [[u' '] * self.numcols for row in range(self.numlines)]
+        self.cursorpos = (0, 0)
 
 
     def home(self):
 
         self.write4bits(self.LCD_RETURNHOME) # set cursor position to zero
         self.delayMicroseconds(2000) # this command takes a long time!
+        self.cursorpos = (0, 0)
         
 
     def clear(self):
 
         self.write4bits(self.LCD_CLEARDISPLAY) # command to clear display
         self.delayMicroseconds(2000)        # 2000 microsecond sleep, clearing the display takes a long time
+        self.clearShadow()
 
 
     def setCursor(self, col, row):
@@ -101,6 +120,7 @@ class Adafruit_CharLCD(object):
                 row = self.numlines - 1 # we count rows starting w/0
 
         self.write4bits(self.LCD_SETDDRAMADDR | (col + self.row_offsets[row]))
+        self.cursorpos = (col, row)
 
 
     def noDisplay(self): 
@@ -185,18 +205,118 @@ class Adafruit_CharLCD(object):
 
 
     def delayMicroseconds(self, microseconds):
-        seconds = microseconds / 1000000        # divide microseconds by 1 million for seconds
+        seconds = microseconds / 1000000.0        # divide microseconds by 1 million for seconds
         sleep(seconds)
 
 
-    def message(self, text):
-        """ Send string to LCD. Newline wraps to second line"""
+    def loadGlyphs(self, lines, protectScreen):
+        """ Make sure the custom glyphs in encoded lines are in CGRAM
+
+        Returns the (value, char_mode) pairs that upload any that weren't,
+        and lines with any glyphs that didn't fit replaced. The uploads
+        leave the LCD writing to CGRAM, so the cursor must be set after
+        them. If protectScreen, glyphs on screen are kept if possible.
+        """
+
+        cells = u''.join(lines)
+        if not cells or max(cells) < charset.GLYPH_BASE:
+            return [], lines
+        needed = []
+        for cell in cells:
+            if cell >= charset.GLYPH_BASE and cell not in needed:
+                needed.append(cell)
+        protect = ()
+        if protectScreen:
+            protect = set(cell for line in self.shadow for cell in line)
+        uploads, evicted = self.glyphs.load(needed, protect)
+        for line in self.shadow:
+            for c, cell in enumerate(line):
+                if cell in evicted:
+                    line[c] = charset.STALE
+        sequence = []
+        for slot, cell in uploads:
+            sequence.append((self.LCD_SETCGRAMADDR | (slot << 3), False))
+            sequence.extend((bits, True) for bits in self.codec.bitmaps[cell])
+        for cell in needed:
+            if self.glyphs.slot(cell) is None:
+                lines = [line.replace(cell, unichr(self.codec.missing)) for line in lines]
+        return sequence, lines
+
+
+    def cellCode(self, cell):
+        """ The character code that shows an encoded cell """
+
+        if cell < charset.GLYPH_BASE:
+            return ord(cell)
+        return self.glyphs.slot(cell)
 
-        for char in text:
-            if char == '\n':
-                self.write4bits(0xC0) # next line
+
+    def message(self, text):
+        """ Send string to LCD. Newline wraps to second line
+
+        Unicode text is encoded for the character ROM, with custom glyphs
+        for what it lacks; byte strings are sent as they are.
+        """
+
+        col, row = self.cursorpos
+        sequence, (cells,) = self.loadGlyphs([self.codec.encode(text)], True)
+        if sequence:
+            sequence.append((self.LCD_SETDDRAMADDR | (col + self.row_offsets[row]), False))
+        for cell in cells:
+            if cell == u'\n':
+                sequence.append((0xC0, False)) # next line
+                col, row = 0, 1
             else:
-                self.write4bits(ord(char),True)
+                sequence.append((self.cellCode(cell), True))
+                if row < self.numlines and col < self.numcols:
+                    self.shadow[row][col] = cell
+                col += 1
+        self.cursorpos = (col, row)
+        self.writeSequence(sequence)
+
+
+    def render(self, lines):
+        """ Make the screen show lines, writing only the characters that changed
+
+        Each line is padded with spaces or cut to the display width. Assumes
+        the display hasn't been scrolled and text runs left to right.
+        """
+
+        lines = [self.codec.encode(line)[:self.numcols].ljust(self.numcols)
+                 for line in lines[:self.numlines]]
+        # Glyphs only on screen now are about to be overwritten anyway.
+        sequence, lines = self.loadGlyphs(lines, False)
+        col, row = self.cursorpos
+        if sequence:
+            col, row = None, None
+        for r, line in enumerate(lines):
+            current = self.shadow[r]
+            for c, cell in enumerate(line):
+                if current[c] == cell:
+                    continue
+                if row == r and c - 1 <= col <= c:
+                    # Rewriting at most one unchanged cell is no dearer
+                    # than moving the cursor.
+                    for skipped in range(col, c):
+                        sequence.append((self.cellCode(current[skipped]), True))
+                else:
+                    sequence.append((self.LCD_SETDDRAMADDR | (c + self.row_offsets[r]), False))
+                sequence.append((self.cellCode(cell), True))
+                current[c] = cell
+                col, row = c + 1, r
+        if row is None:
+            # The glyph uploads left the LCD writing to CGRAM.
+            col, row = self.cursorpos
+            sequence.append((self.LCD_SETDDRAMADDR | (col + self.row_offsets[row]), False))
+        self.cursorpos = (col, row)
+        self.writeSequence(sequence)
+
+
+    def writeSequence(self, sequence):
+        """ Send a list of (value, char_mode) pairs to the LCD """
+
+        for value, char_mode in sequence:
+            self.write4bits(value, char_mode)
 
 
 class Adafruit_GPIO_CharLCD(Adafruit_CharLCD):
@@ -270,31 +390,65 @@ class Adafruit_I2C_CharLCD(Adafruit_CharLCD):
     PIN_OTHER     = 0x20
     PIN_REGSEL    = 0x10
 
+    I2C_BLOCK_MAX = 32
+
     def __init__(self, i2c, address):
         self.i2c = i2c
         self.address = address
+        self.expander = mcp23008.Expander(i2c, address)
         
-        i2c.write_byte_data(address, self.MCP_IOCON, 0x24) # SEQOP = 1, ODR = 1
+        self.expander.iocon = 0x24 # SEQOP = 1, ODR = 1
         self.backlight()
 
         super(Adafruit_I2C_CharLCD, self).__init__()
+
+    @property
+    def transactions(self):
+        """ Number of I2C transfers made so far """
+
+        return self.expander.transactions
    
     def backlight(self):
-        self.i2c.write_byte_data(self.address, self.MCP_IODIR, 0)
+        self.expander.iodir = 0
     
     def noBacklight(self):
-        self.i2c.write_byte_data(self.address, self.MCP_IODIR, self.PIN_BACKLIGHT)
+        self.expander.iodir = self.PIN_BACKLIGHT
     
     def write4bits(self, value, char_mode=False):
-        self.reallywrite4bits(value >> 4, char_mode)
-        self.reallywrite4bits(value & 0x0F, char_mode)
+        self.writeSequence([(value, char_mode)])
     
     def reallywrite4bits(self, value, char_mode=False):
         value |= self.PIN_BACKLIGHT | self.PIN_ENABLE
         if char_mode:
             value |= self.PIN_REGSEL
-        self.i2c.write_i2c_block_data(self.address, self.MCP_GPIO,
-                                  [value, value ^ self.PIN_ENABLE, value])
+        self.expander.gpio = [value, value ^ self.PIN_ENABLE, value]
+
+    def writeSequence(self, sequence):
+        """ Send many bytes in as few I2C block writes as possible
+
+        With SEQOP set every byte of a block write goes to GPIO, so each
+        nibble is two bytes: data with enable high, then enable low to latch
+        it. A block ends by raising enable again, as reallywrite4bits does.
+        """
+
+        block = []
+        for value, char_mode in sequence:
+            mode = self.PIN_BACKLIGHT | self.PIN_ENABLE
+            if char_mode:
+                mode |= self.PIN_REGSEL
+            for nibble in (value >> 4, value & 0x0F):
+                if len(block) + 3 > self.I2C_BLOCK_MAX:
+                    self._writeBlock(block)
+                    block = []
+                nibble |= mode
+                block.append(nibble)
+                block.append(nibble ^ self.PIN_ENABLE)
+        if block:
+            self._writeBlock(block)
+
+    def _writeBlock(self, block):
+        block.append(block[-2])
+        self.expander.write_sequence(self.MCP_GPIO, block)
 
                                   
 if __name__ == '__main__':
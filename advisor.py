@@ -1,20 +1,52 @@
 import Adafruit_CharLCD
+import argparse
+import cache
+import coin
+import collections
 import functools
+import gpioedge
+import journal
 import math
+import metrics
 import os
+import pregen
+import Queue
 import random
-import RPi.GPIO as GPIO
-import smbus
+import reactor
+import rendersvc
+import sampler
 import strfile
-import serial
+import signal
+import socket
+import spooler
+import sys
+import thermal
+import threading
 import time
+import tracing
 import ui
+from wrapping import unwrap, wrap
 
+# 'rpi' to use the real GPIO pins, display and printer, or 'simulated' to run
+# on any machine against models of them, with simulation_script as input.
+hardware_backend = 'rpi'
 fortune_base = '/usr/share/games/fortunes'
+render_cache_bytes = 256 * 1024
+max_open_databases = 4
+# The fortunes on a receipt are chosen to fit in print_budget[0] printed lines
+# plus print_budget[1] lines per penny, so a small coin can't tie up the
+# printer with a very long fortune. Budgets are rounded down to one of
+# print_budget_edges.
+print_budget = (16, 0.6)
+print_budget_edges = (2, 4, 6, 8, 10, 12, 14, 16, 20, 24, 28, 32, 40, 48, 64, 80, 96, 128)
 printer_tty = '/dev/ttyAMA0'
 printer_baud = 19200
+printer_bytes_per_second = printer_baud / 10.0
+printer_line_time = 0.1
+printer_buffer_size = 256
+max_print_jobs = 2
 printer_currency_symbol = '\x9C'
-lcd_currency_symbol = '\x93'
+lcd_currency_symbol = u'\u00a3'
 buttons = (
     (16, 'black'),
     (12, 'white'),
@@ -23,8 +55,65 @@ buttons = (
     (23, 'blue'),
 )
 coin_input = 26
+# 'edge' to be told about input changes by GPIO interrupts, 'poll' to sample
+# the inputs every 10ms.
+input_backend = 'edge'
+# Milliseconds after a button's edge during which its contacts' bounces are
+# ignored, when input_backend is 'edge'. The button is read again after
+# that, in case the bounce ended at a different level.
+button_bouncetime = 20
+# 'reactor' to run input handling, the display and the printer as tasks on
+# one event loop, or 'threads' to poll the inputs and print on threads of
+# their own.
+app_core = 'reactor'
+# Seconds between polls of the inputs when input_backend is 'poll'. Buttons
+# are polled quickly for a second after they change and slowly otherwise;
+# the coin input is polled quickly while pulses are arriving.
+button_poll_intervals = (0.01, 0.05)
+coin_poll_intervals = (0.01, 0.002)
+# Shortest and longest acceptable coin pulse, and shortest and longest gap
+# between the pulses of one coin, in seconds. A longer gap ends the coin.
+coin_pulse_width = (0.005, 0.15)
+coin_pulse_gap = (0.005, 0.1)
 display_bus = 0
 display_address = 0x24
+# Seconds without input before the display's backlight goes off.
+backlight_timeout = 10.0
+# Metrics are written here for node_exporter's textfile collector, at most
+# once every metrics_interval seconds. None turns the export off.
+metrics_path = '/var/lib/node_exporter/textfile_collector/advisor.prom'
+metrics_interval = 60
+# The most recent trace_spans pipeline stages are kept in memory, and written
+# to trace_path on SIGUSR1.
+trace_spans = 2048
+trace_path = '/tmp/advisor-trace.txt'
+# advisor.py --serve renders receipts for kiosks on this socket. Kiosks with
+# use_render_server set fetch their receipts from it, and only generate them
+# themselves if it can't be reached. The fetch holds up the kiosk's event
+# loop, so it gives up after render_timeout seconds (twice that if a kept
+# connection has to be reopened).
+render_socket = '/tmp/advisor-render.sock'
+use_render_server = False
+render_timeout = 0.25
+# Coins, dispenses and donations are journaled here, so credit survives a
+# crash or restart. Records are fsynced in groups, at most
+# journal_commit_window seconds after they happen, and the journal is
+# compacted into a snapshot every journal_compact_after records. None turns
+# the journal off.
+journal_path = '/var/lib/advisor/journal'
+journal_commit_window = 0.05
+journal_compact_after = 1000
+# Played over and over when hardware_backend is 'simulated'. Each step is
+# ('wait', seconds), ('press', button name) or ('coin', value).
+simulation_script = (
+    ('wait', 3.0),
+    ('coin', 20),
+    ('wait', 1.0),
+    ('coin', 50),
+    ('wait', 1.0),
+    ('press', 'green'),
+    ('wait', 10.0),
+)
 
 coin_values = {
     1: 5,
@@ -52,6 +141,33 @@ extra_fortunes = (
 
 hr = '-' * 32
 
+registry = metrics.Registry()
+coins_counter = registry.counter(
+    'advisor_coins_total', 'Coins inserted, by value in pence.', ['value'])
+rejected_coins_counter = registry.counter(
+    'advisor_coins_rejected_total', 'Coin pulse trains that could not be read.',
+    ['reason'])
+receipts_counter = registry.counter(
+    'advisor_receipts_printed_total', 'Receipts printed.')
+print_errors_counter = registry.counter(
+    'advisor_print_errors_total', 'Receipts that failed to print.')
+printer_bytes_counter = registry.counter(
+    'advisor_printer_bytes_total', 'Bytes written to the printer.')
+printer_seconds_histogram = registry.histogram(
+    'advisor_printer_seconds', 'Time taken to send a receipt to the printer.',
+    (1, 2, 5, 10, 20, 30, 60))
+printer_rate_gauge = registry.gauge(
+    'advisor_printer_bytes_per_second', 'Rate the last receipt was sent to the printer at.')
+fortunes_counter = registry.counter(
+    'advisor_fortunes_total', 'Fortunes dispensed, by database.', ['database'])
+render_latency_histogram = registry.histogram(
+    'advisor_render_seconds', 'Time taken to render a receipt for a kiosk.',
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+event_latency_histogram = registry.histogram(
+    'advisor_event_latency_seconds',
+    'Time from an input event happening to the application handling it.',
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
 databases = (
     (7,     ('disclaimer', 'miscellaneous', 'riddles')),
     (15,    ('platitudes', 'paradoxum', 'love')),
@@ -59,120 +175,235 @@ databases = (
     (75,    ('politics', 'science', 'humorists')),
     (150,   ('literature', 'wisdom', 'tao')),
 )
+# Databases are opened on first read, and at most max_open_databases of
+# them are kept open.
+database_pool = strfile.HandlePool(max_open_databases)
 databases = tuple((value,
-                   tuple(strfile.Strfile(os.path.join(fortune_base, dbname))
+                   tuple(strfile.Strfile(os.path.join(fortune_base, dbname),
+                                         use_mmap=True, pool=database_pool)
                          for dbname in dbnames))
                   for value, dbnames in databases)
 
-def pick_fortune_set(value):
-    for v, dbs in databases:
-        if v >= value:
-            return dbs
-    return databases[-1][1]
-
-def pick_fortune_db(value):
-    dbs = pick_fortune_set(value)
-    total = sum(db.numstr for db in dbs)
-    r = random.randrange(total)
-    for db in dbs:
-        if db.numstr > r:
-            return db
-        r -= db.numstr
-
-def pick_fortune(value):
-    db = pick_fortune_db(value)
-    return db.read_random()
-
-def unwrap(lines):
-    """Takes line wrapped text and 'unwraps' it.
-    
-    Arguments:
-      lines: A list of lines in the original text, optionally newline terminated.
-    Returns:
-      A list of paragraphs, not newline terminated.
+# Relative weight of a single fortune from each database, by name. Databases
+# not listed have weight 1.0, so every fortune in a tier is equally likely.
+database_weights = {}
+
+def fortune_lengths(db):
+    """Returns the printed length of each fortune in db, in lines.
+
+    They are read from the length index mkstrfile writes, or worked out
+    from the fortunes if it is missing or out of date.
     """
-    if not lines:
-        return lines
-    paras = []
-    current = [lines[0].strip()]
-    for line in lines[1:]:
-        if line.startswith('\t') or line.startswith('<'):
-            # Indent or symbol means a mandatory linebreak
-            paras.append(' '.join(current))
-            current = [line.strip()]
-        else:
-            # Append to current line
-            current.append(line.strip())
-    paras.append(' '.join(current))
-    return paras
+    lengths = db.read_lengths(32)
+    if lengths is None:
+        lengths = [len(wrap(unwrap(db.read(index)))) for index in xrange(db.numstr)]
+    return lengths
 
-def wrap(paras, maxlen=32):
-    """Line wraps a set of paragraphs.
-    
-    Arguments:
-      paras: A list of paragraph strings, not newline terminated.
-      maxlen: Length to wrap at.
-    Returns:
-      A list of line strings each no longer than maxlen, newline
-      terminated. Each paragraph is separated by a blank line.
+fortune_sampler = sampler.BudgetSampler(databases, fortune_lengths, print_budget_edges,
+                                        database_weights)
+
+tracer = tracing.Tracer(trace_spans)
+
+render_cache = cache.LRUCache(render_cache_bytes, cache.lines_size)
+registry.callback('advisor_render_cache_hits_total',
+                  'Fortunes found already wrapped in the render cache.', 'counter',
+                  lambda: render_cache.hits)
+registry.callback('advisor_render_cache_misses_total',
+                  'Fortunes that had to be wrapped.', 'counter',
+                  lambda: render_cache.misses)
+registry.callback('advisor_render_cache_evictions_total',
+                  'Wrapped fortunes dropped from the render cache to make room.', 'counter',
+                  lambda: render_cache.evictions)
+registry.callback('advisor_render_cache_bytes',
+                  'Size of the wrapped fortunes in the render cache.', 'gauge',
+                  lambda: render_cache.size)
+
+def render_fortune(db, index, maxlen=32):
+    """Returns fortune number index from db, unwrapped and wrapped to maxlen.
+
+    Results are kept in render_cache; callers must not modify the list.
     """
-    lines = []
-    for para in paras:
-        while len(para) > maxlen:
-            lastbreak = para.rfind(' ', 0, maxlen + 1)
-            if lastbreak == -1:
-                lastbreak = maxlen
-            if lastbreak == maxlen:
-                lines.append(para[:lastbreak])
-            else:
-                lines.append(para[:lastbreak] + '\n')
-            para = para[lastbreak+1:]
-        if len(para) == maxlen:
-            lines.append(para)
-        elif para.strip():
-            lines.append(para + '\n')
-        lines.append('\n')
+    key = (db.name, index, maxlen)
+    lines = render_cache.get(key)
+    if lines is None:
+        with tracer.span('read', db=db.name, index=index):
+            block = db.read_raw(index)
+        with tracer.span('decode'):
+            lines = db.decode(block)
+        with tracer.span('unwrap'):
+            paras = unwrap(lines)
+        with tracer.span('wrap'):
+            lines = wrap(paras, maxlen)
+        render_cache.put(key, lines)
     return lines
 
 
-printer = serial.Serial(printer_tty, printer_baud)
-printer.write('\x1B{1')
+Hardware = collections.namedtuple('Hardware', 'gpio SMBus Serial')
 
-def print_message(lines):
-    for line in lines[::-1]:
-        printer.write(line)
+def load_hardware(backend):
+    """Returns the GPIO module and SMBus and Serial classes for backend.
 
+    The hardware libraries are only imported here, so the rest of this module
+    works on machines without them.
+    """
+    if backend == 'simulated':
+        import hwsim
+        return Hardware(hwsim.GPIO(), hwsim.SMBus, hwsim.Serial)
+    import RPi.GPIO
+    import serial
+    import smbus
+    return Hardware(RPi.GPIO, smbus.SMBus, serial.Serial)
 
-def generate_wisdom(value):
+# Set by main().
+hardware = None
+
+def open_printer():
+    return thermal.ThermalPrinter(hardware.Serial(printer_tty, printer_baud),
+                                  printer_bytes_per_second, printer_line_time,
+                                  printer_buffer_size)
+
+def print_message(printer, job):
+    trace_id, lines = job
+    with tracer.trace(trace_id), tracer.span('write') as attrs:
+        stats = printer.print_lines(lines)
+        attrs.update(print_stats_attrs(stats))
+    return stats
+
+def print_stats_attrs(stats):
+    """Returns the 'write' span attributes for a receipt's PrintStats."""
+    return {'bytes': stats.bytes, 'seconds': '%.3f' % stats.elapsed,
+            'bytes_per_second': '%.0f' % stats.bytes_per_second}
+
+def print_message_steps(printer, job):
+    """print_message() for a spooler.TaskSpooler."""
+    trace_id, lines = job
+    start = tracer.time_func()
+    for delay in printer.print_steps(lines):
+        yield delay
+    stats = printer.last_stats
+    tracer.record(trace_id, 'write', start, tracer.time_func(), print_stats_attrs(stats))
+    raise StopIteration(stats)
+
+# Replaced by main() with a spooler.TaskSpooler when app_core is 'reactor'.
+print_spooler = spooler.Spooler(open_printer, print_message, max_print_jobs)
+
+
+def generate_header(value):
     message = []
     message.append('\n')
     message.append('\n')
     message.append('Your %s%.2f of wisdom:\n' % (printer_currency_symbol, value / 100.0))
     message.append('\n')
     message.append('\n')
+    return message
 
+def print_lines_budget(value):
+    """Returns how many printed lines of fortunes value pays for."""
+    return print_budget[0] + print_budget[1] * value
+
+def pick_fortune_within(value, budget):
+    """Picks a fortune for value no longer than budget lines, or returns None."""
+    with tracer.span('select', value=int(value), budget=int(budget)) as attrs:
+        picked = fortune_sampler.pick_within(value, budget)
+        attrs['db'] = picked and picked[0].name
+    return picked
+
+def generate_fortunes(value, sources=None):
+    """Returns the fortunes for value, appending their databases' names to sources."""
+    message = []
+    budget = print_lines_budget(value)
     value *= random.random() + 0.5 # Increase or decrease the value a bit
     num_extra_fortunes = 0
-    while value > 0:
+    # Each fortune is printed between two rules.
+    picked = pick_fortune_within(value, budget - 2)
+    if picked is None:
+        # Always print something, however long.
+        picked = pick_fortune_within(value, ui.INFINITY)
+    while picked:
+        db, index = picked
+        if sources is not None:
+            sources.append(db.name)
+        lines = render_fortune(db, index)
         message.append(hr)
-        message.extend(wrap(unwrap(pick_fortune(value))))
+        message.extend(lines)
         message.append(hr)
+        budget -= len(lines) + 2
         value += math.log(random.random()) / math.log(1/.995)
         value /= 2
-        if value > 0:
+        if value <= 0:
+            break
+        # An extra fortune also needs its heading.
+        picked = pick_fortune_within(value, budget - 6)
+        if picked:
             message.append('\n')
             message.append(extra_fortunes[num_extra_fortunes])
             message.append('\n')
             message.append('\n')
+            budget -= 4
             num_extra_fortunes = min(num_extra_fortunes + 1, len(extra_fortunes) - 1)
     return message
 
+def generate_wisdom(value):
+    return generate_header(value) + generate_fortunes(value)
+
+def count_fortunes(sources):
+    """Counts fortunes handed out from the databases named in sources."""
+    for name in sources:
+        fortunes_counter.inc(database=name)
+
+def generate_traced_fortunes(value):
+    """Returns the id of the trace the fortunes were generated in, their
+    databases' names and the fortunes."""
+    with tracer.trace() as trace_id, tracer.span('generate', value=value):
+        sources = []
+        fortunes = generate_fortunes(value, sources)
+        return trace_id, sources, fortunes
+
+# Fortunes for a receipt are generated in the background for each balance
+# the customer can reach with one more coin. They are only used for exactly
+# that balance, since the number and length of fortunes depend on it.
+receipt_pregenerator = pregen.Pregenerator(generate_traced_fortunes)
+
+# Set by main() if use_render_server.
+render_client = None
+
+# Set by main() if journal_path.
+coin_journal = None
+
+def prepare_wisdom(balance):
+    """Pre-generates receipts for balance and for one more coin on top of it."""
+    if render_client:
+        return
+    values = [balance + coin for coin in coin_values.itervalues()]
+    if balance:
+        values.append(balance)
+    receipt_pregenerator.prepare(values)
+
 def dispense_wisdom(value):
-    print_message(generate_wisdom(value))
+    """Queues a receipt for value. Raises Queue.Full if the printer is backed up."""
+    with tracer.trace() as trace_id, tracer.span('dispense', value=value):
+        receipt = None
+        # Receipts from the render server are counted there.
+        sources = ()
+        if render_client:
+            with tracer.span('fetch') as attrs:
+                try:
+                    receipt = render_client.render(value)
+                    attrs['server_ms'] = '%.3f' % (render_client.latencies[0][0] * 1000)
+                except (socket.error, rendersvc.RenderError) as e:
+                    attrs['error'] = str(e).replace(' ', '_')
+        if receipt is None:
+            with tracer.span('take') as attrs:
+                generated, sources, fortunes = receipt_pregenerator.take(value)
+                # A different trace id means the fortunes were pregenerated there.
+                attrs['generated'] = generated
+            receipt = generate_header(value) + fortunes
+        print_spooler.submit((trace_id, receipt))
+        count_fortunes(sources)
 
 class MenuHandler(object):
-    MENU_UP = '\xa2'
-    MENU_DN = '\xa3'
+    MENU_UP = u'\u25b2'
+    MENU_DN = u'\u25bc'
     
     def __init__(self, options, display):
         self.options = options
@@ -180,20 +411,18 @@ class MenuHandler(object):
         self.position = 0
 
     def draw_menu(self):
-        display = self.display
-        display.clear()
         if self.position > 0:
-            display.message(self.MENU_UP)
+            top = self.MENU_UP
         else:
-            display.message(' ')
-        display.message(self.options[self.position].rjust(15))
-        display.setCursor(0, 1)
+            top = ' '
+        top += self.options[self.position].rjust(15)
         if len(self.options) > self.position + 2:
-            display.message(self.MENU_DN)
+            bottom = self.MENU_DN
         else:
-            display.message(' ')
+            bottom = ' '
         if len(self.options) > self.position + 1:
-            display.message(self.options[self.position + 1].rjust(15))
+            bottom += self.options[self.position + 1].rjust(15)
+        self.display.render([top, bottom])
 
     def handle_input(self, event):
         if event.args == 'black' and self.position > 0:
@@ -219,57 +448,136 @@ class STATES(object):
 class AdvisorApplication(object):
     def __init__(self, ui_thread, display):
         self.ui_thread = ui_thread
-        self.display_timeout = ui.TimeoutEventHandler()
+        self.display_timeout = ui.TimeoutEventHandler(self.ui_thread.wake)
         self.ui_thread.poll_functions.append(self.display_timeout)
+        self._init(display, self.ui_thread.post, self.ui_thread.q.qsize)
+
+    def _init(self, display, post, queue_depth):
         self.display = display
         self.balance = 0
         self.state = STATES.IDLE
         self.donation_menu = None
-        self._show_insert_coin()
+        self.printing = 0
+        print_spooler.on_complete = post
+        registry.callback('advisor_i2c_transactions_total',
+                          'I2C transfers made to the display.', 'counter',
+                          lambda: getattr(display, 'transactions', 0))
+        registry.callback('advisor_event_queue_depth',
+                          'Input events waiting to be handled.', 'gauge',
+                          queue_depth)
+        jitter = self.ui_thread.jitter
+        registry.callback('advisor_input_polls_total',
+                          'Scheduled polls of the inputs.', 'counter',
+                          lambda: jitter.count)
+        registry.callback('advisor_input_poll_lateness_mean_seconds',
+                          'Mean time input polls ran after they were due.', 'gauge',
+                          lambda: jitter.mean)
+        registry.callback('advisor_input_poll_lateness_max_seconds',
+                          'Longest time an input poll ran after it was due.', 'gauge',
+                          lambda: jitter.max)
+        if coin_journal:
+            self._recover()
+        prepare_wisdom(self.balance)
+        if self.balance:
+            self.state = STATES.IN_USE
+            self._show_total()
+        else:
+            self._show_insert_coin()
+
+    def _recover(self):
+        """Restores the balance and donation totals from coin_journal, and starts it.
+
+        If the journal can't be read or written, the machine runs without one.
+        """
+        global coin_journal
+        try:
+            snapshot, records = coin_journal.recover()
+            if snapshot:
+                self.balance = int(snapshot[0])
+                for i, total in enumerate(snapshot[1:len(donation_totals) + 1]):
+                    donation_totals[i] = int(total)
+            for words in records:
+                self._replay(words)
+            coin_journal.start(self._snapshot)
+        except (IOError, OSError) as e:
+            sys.stderr.write('advisor: running without a coin journal: %s\n' % e)
+            coin_journal = None
+
+    def _snapshot(self):
+        return [self.balance] + donation_totals
+
+    def _replay(self, words):
+        if words[0] == 'coin':
+            self.balance += int(words[1])
+        elif words[0] == 'dispense':
+            self.balance = 0
+        elif words[0] == 'donate':
+            donation_totals[int(words[1])] = int(words[2])
+
+    def _record(self, words, commit=False):
+        if coin_journal:
+            coin_journal.append(words, commit)
         
     def _show_insert_coin(self):
-        time.sleep(0.01)
-        self.display.clear()
-        time.sleep(0.01)
-        self.display.message("   INSERT COIN  ")
+        self.display.render(["   INSERT COIN  ", ""])
 
     def _show_total(self):
-        self.display.clear()
-        time.sleep(0.01)
-        self.display.message(
-            "Total: %s%.2f" % (lcd_currency_symbol, self.balance / 100.0))
-        time.sleep(0.01)
-        self.display.setCursor(0, 1)
-        time.sleep(0.01)
-        #self.display.message("\x7fDonate  Advice\x7e")
-        self.display.message("      Advise Me\x7e");
+        self.display.render([
+            "Total: %s%.2f" % (lcd_currency_symbol, self.balance / 100.0),
+            #"\x7fDonate  Advice\x7e",
+            "      Advise Me\x7e",
+        ])
+
+    def _show_busy(self):
+        self.display.render(["  Printer busy  ", " Please wait... "])
 
     def _dispense_wisdom(self):
-        self.display.clear()
-        self.display.message("   Dispensing   ")
-        self.display.setCursor(0, 1)
-        self.display.message("    wisdom...   ")
-        dispense_wisdom(self.balance)
-        self.balance = 0
-        self._show_insert_coin()
+        try:
+            dispense_wisdom(self.balance)
+        except Queue.Full:
+            self._show_busy()
+            return STATES.IN_USE
+        self.printing += 1
+        self.display.render(["   Dispensing   ", "    wisdom...   "])
+        dispensed, self.balance = self.balance, 0
+        # The credit has become a receipt, so don't wait to commit that.
+        self._record(['dispense', dispensed], commit=True)
+        prepare_wisdom(self.balance)
+        return STATES.IDLE
+
+    def _printed(self, event):
+        self.printing -= 1
+        if event.error is None:
+            receipts_counter.inc()
+            printer_bytes_counter.inc(event.result.bytes)
+            printer_seconds_histogram.observe(event.result.elapsed)
+            printer_rate_gauge.set(event.result.bytes_per_second)
+        else:
+            print_errors_counter.inc()
+        if self.state == STATES.IDLE and not self.printing:
+            self._show_insert_coin()
+
+    def _add_coin(self, value):
+        coins_counter.inc(value=value)
+        self.balance += value
+        self._record(['coin', value])
+        prepare_wisdom(self.balance)
+        self._show_total()
 
     def _idle_event(self, event):
         self.display.backlight()
         if event.args == 'coin':
-            self.balance += coin_values[event.state]
-            self._show_total()
+            self._add_coin(coin_values[event.state])
             return STATES.IN_USE
         else:
             return STATES.IDLE    
     
     def _in_use_event(self, event):
         if event.args == 'coin':
-            self.balance += coin_values[event.state]
-            self._show_total()
+            self._add_coin(coin_values[event.state])
             return STATES.IN_USE
         elif event.args == 'green':
-            self._dispense_wisdom()
-            return STATES.IDLE
+            return self._dispense_wisdom()
         #elif event.args == 'white':
         #    self.donation_menu = MenuHandler(donation_options, self.display)
         #    self.donation_menu.draw_menu()
@@ -281,8 +589,8 @@ class AdvisorApplication(object):
         selection = self.donation_menu.handle_input(event)
         if selection:
             donation_totals[selection] = self.balance
-            self._dispense_wisdom()
-            return STATES.IDLE
+            self._record(['donate', selection, self.balance])
+            return self._dispense_wisdom()
         else:
             return STATES.DONATE
     
@@ -292,48 +600,321 @@ class AdvisorApplication(object):
         STATES.DONATE: _donate_event,
     }
     
+    def _keep_lit(self):
+        self.display_timeout.set_timeout(backlight_timeout)
+
+    def _handle(self, event):
+        event_latency_histogram.observe(self.ui_thread.time_func() - event.now)
+        if isinstance(event, ui.TimeoutEvent):
+            self.display.noBacklight()
+        elif isinstance(event, spooler.PrintedEvent):
+            self._printed(event)
+        elif isinstance(event, coin.RejectedCoinEvent):
+            # There is no value to credit.
+            rejected_coins_counter.inc(reason=event.reason)
+        else:
+            self._keep_lit()
+            if event.args == 'coin' or event.state == False:
+                self.state = self.event_handlers[self.state](self, event)
+
+    def _start_workers(self):
+        """Starts the metrics exporter, receipt pregenerator and print spooler."""
+        exporter = None
+        if metrics_path:
+            exporter = metrics.TextfileExporter(registry, metrics_path, metrics_interval)
+            exporter.start()
+        receipt_pregenerator.start()
+        print_spooler.start()
+        return exporter
+
+    def _stop_workers(self, exporter):
+        try:
+            print_spooler.stop()
+            receipt_pregenerator.stop()
+            if exporter:
+                exporter.stop()
+        finally:
+            if coin_journal:
+                coin_journal.stop()
+
     def run(self):
+        exporter = self._start_workers()
         self.ui_thread.start()
         try:
             for event in self.ui_thread:
-                if isinstance(event, ui.TimeoutEvent):
-                    self.display.noBacklight()
-                else:
-                    self.display_timeout.set_timeout(10.0)
-                    if event.args == 'coin' or event.state == False:
-                        self.state = self.event_handlers[self.state](self, event)
+                self._handle(event)
         finally:
             self.ui_thread.stop()
+            self._stop_workers(exporter)
+
+
+class DisplayTask(object):
+    """Stands in for the display, which a reactor task draws on.
+
+    render(), backlight() and noBacklight() only record what should be
+    shown, and the task catches the display up. A screen replaced before
+    the task gets to it is never sent, and the backlight is only switched
+    when it changes.
+
+    Attributes:
+      lines: The lines last passed to render().
+    """
+
+    def __init__(self, loop, display):
+        self.loop = loop
+        self.display = display
+        self.lines = None
+        self.lit = True
+        self.changed = reactor.Channel(loop)
+        self.task = None
+
+    @property
+    def transactions(self):
+        return getattr(self.display, 'transactions', 0)
+
+    def start(self):
+        self.task = self.loop.spawn(self._run())
+
+    def render(self, lines):
+        self.lines = list(lines)
+        self._changed()
+
+    def backlight(self):
+        self.lit = True
+        self._changed()
+
+    def noBacklight(self):
+        self.lit = False
+        self._changed()
+
+    def _changed(self):
+        if not len(self.changed):
+            self.changed.put(None)
+
+    def _run(self):
+        shown_lines = shown_lit = None
+        while True:
+            yield self.changed.get()
+            if self.lit != shown_lit:
+                if self.lit:
+                    self.display.backlight()
+                else:
+                    self.display.noBacklight()
+                shown_lit = self.lit
+            if self.lines != shown_lines:
+                self.display.render(self.lines)
+                shown_lines = self.lines
+
+
+class ReactorApplication(AdvisorApplication):
+    """Runs the machine as tasks on a reactor.Reactor, on one thread.
+
+    Inputs are polled by timers, and straight away when an edge source
+    wakes ui_thread, which is used for its handlers but not started. Events
+    go to a task running the state machine, screens to a DisplayTask, and
+    receipts to print_spooler, which must be a spooler.TaskSpooler on loop.
+    Nothing sleeps on the loop, so while a receipt prints the display is
+    animated and coins are counted between the printer's writes.
+    """
+
+    DISPENSING_FRAMES = [["   Dispensing   ", ("    wisdom" + '.' * dots).ljust(16)]
+                         for dots in range(4)]
+    ANIMATION_INTERVAL = 0.4
+
+    def __init__(self, loop, ui_thread, display):
+        self.loop = loop
+        self.ui_thread = ui_thread
+        self.events = reactor.Channel(loop)
+        self.input_timer = None
+        self.backlight_timer = None
+        self.animation = None
+        self._init(DisplayTask(loop, display), self.events.put, self.events.__len__)
+
+    def _keep_lit(self):
+        if self.backlight_timer:
+            self.backlight_timer.cancel()
+        self.backlight_timer = self.loop.call_later(backlight_timeout,
+                                                    self.display.noBacklight)
+
+    def _dispense_wisdom(self):
+        state = super(ReactorApplication, self)._dispense_wisdom()
+        if self.printing and self.display.lines == self.DISPENSING_FRAMES[-1]:
+            if self.animation:
+                self.animation.cancel()
+            self.animation = self.loop.spawn(
+                self._animate(self.DISPENSING_FRAMES, self.ANIMATION_INTERVAL))
+        return state
+
+    def _animate(self, frames, interval):
+        """Cycles the display through frames until something else is drawn."""
+        frame = self.display.lines
+        while True:
+            for next_frame in frames:
+                yield interval
+                if self.display.lines != frame:
+                    return
+                self.display.render(next_frame)
+                frame = self.display.lines
+
+    def _poll_inputs(self):
+        if self.input_timer:
+            self.input_timer.cancel()
+        wake_at = self.ui_thread.poll(self.ui_thread.time_func(), self.events.put)
+        self.input_timer = self.loop.call_at(wake_at, self._poll_inputs)
+
+    def _woken(self):
+        self.ui_thread.clear_wake()
+        self._poll_inputs()
+
+    def _handle_events(self):
+        while True:
+            event = yield self.events.get()
+            self._handle(event)
+
+    def run(self):
+        exporter = self._start_workers()
+        self.display.start()
+        self.loop.add_reader(self.ui_thread.fileno(), self._woken)
+        self.loop.call_soon(self._poll_inputs)
+        self.loop.spawn(self._handle_events())
+        try:
+            self.loop.run()
+        finally:
+            self.loop.remove_reader(self.ui_thread.fileno())
+            if self.input_timer:
+                self.input_timer.cancel()
+            self._stop_workers(exporter)
 
             
-def main():
-    GPIO.setmode(GPIO.BOARD)
-    
-    for pin, name in buttons:
-        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    input_handlers = [ui.InputEventHandler(functools.partial(GPIO.input, pin), name)
+def setup_polled_inputs(gpio):
+    input_handlers = [ui.InputEventHandler(functools.partial(gpio.input, pin), name,
+                                           *button_poll_intervals)
                       for pin, name in buttons]
-    
-    GPIO.setup(coin_input, GPIO.IN)
     input_handlers.append(ui.MultiPulseEventHandler(
-        functools.partial(GPIO.input, coin_input),
+        functools.partial(gpio.input, coin_input),
         True,
         0.1,
-        'coin'))
-    ui_thread = ui.UIEventGenerator(0.01, input_handlers)
+        'coin',
+        *coin_poll_intervals))
+    return ui.UIEventGenerator(0.01, input_handlers)
+
+def setup_edge_inputs(gpio):
+    pins = [(pin, ui.EdgeInputHandler(name, gpio.input(pin),
+                                      settle_time=button_bouncetime / 1000.0))
+            for pin, name in buttons]
+    pins.append((coin_input, coin.CoinPulseDecoder(
+        True, coin_values, coin_pulse_width[0], coin_pulse_width[1],
+        coin_pulse_gap[0], coin_pulse_gap[1])))
+    ui_thread = ui.UIEventGenerator(0.01, [handler for pin, handler in pins])
+    sources = []
+    for pin, handler in pins:
+        handler.wake = ui_thread.wake
+        if pin == coin_input:
+            sources.append(gpioedge.RPiEdgeSource(gpio, pin, handler, bool(gpio.input(pin))))
+        else:
+            sources.append(gpioedge.RPiEdgeSource(gpio, pin, handler, bool(gpio.input(pin)),
+                                                  button_bouncetime))
+            handler.resample = sources[-1].resample
+    registry.callback('advisor_gpio_missed_edges_total',
+                      'GPIO edges over before the pin could be read.', 'counter',
+                      lambda: sum(source.missed for source in sources))
+    return ui_thread
+
+def play_simulation(gpio, script):
+    """Plays script on simulated inputs, over and over."""
+    pins = dict((name, pin) for pin, name in buttons)
+    pulse_counts = dict((value, count) for count, value in coin_values.iteritems())
+    while True:
+        for action, arg in script:
+            if action == 'wait':
+                time.sleep(arg)
+            elif action == 'press':
+                gpio.press(pins[arg])
+            elif action == 'coin':
+                gpio.pulse_train(coin_input, pulse_counts[arg], 0.03, 0.05)
+
+def serve(path):
+    """Renders receipts for kiosks on a Unix socket at path, until interrupted."""
+    def render(value):
+        sources = []
+        receipt = generate_header(value) + generate_fortunes(value, sources)
+        count_fortunes(sources)
+        return receipt
+    server = rendersvc.RenderServer(path, render, render_latency_histogram.observe)
+    exporter = None
+    if metrics_path:
+        exporter = metrics.TextfileExporter(registry, metrics_path, metrics_interval)
+        exporter.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+        if exporter:
+            exporter.stop()
+
+def terminate(signum, frame):
+    """Exits through the usual cleanup, which commits the coin journal."""
+    raise SystemExit(0)
+
+def main():
+    global hardware, render_client, print_spooler, coin_journal
+    hardware = load_hardware(hardware_backend)
+    if use_render_server:
+        render_client = rendersvc.RenderClient(render_socket, render_timeout)
+    if journal_path:
+        coin_journal = journal.Journal(journal_path, journal_commit_window,
+                                       journal_compact_after)
+        registry.callback('advisor_journal_commits_total',
+                          'Groups of coin journal records fsynced.', 'counter',
+                          lambda: coin_journal.commits if coin_journal else 0)
+        registry.callback('advisor_journal_errors_total',
+                          'Coin journal commits that failed.', 'counter',
+                          lambda: coin_journal.errors if coin_journal else 0)
+    gpio = hardware.gpio
+    tracer.dump_on_signal(signal.SIGUSR1, trace_path)
+    signal.signal(signal.SIGTERM, terminate)
+    gpio.setmode(gpio.BOARD)
+    
+    for pin, name in buttons:
+        gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.setup(coin_input, gpio.IN)
+    if input_backend == 'edge':
+        ui_thread = setup_edge_inputs(gpio)
+    else:
+        ui_thread = setup_polled_inputs(gpio)
     
     display = Adafruit_CharLCD.Adafruit_I2C_CharLCD(
-        smbus.SMBus(display_bus), display_address)
+        hardware.SMBus(display_bus), display_address)
     time.sleep(0.1)
     display.begin(16, 2)
     display.clear()
 
+    if hardware_backend == 'simulated':
+        player = threading.Thread(target=play_simulation, args=(gpio, simulation_script))
+        player.daemon = True
+        player.start()
+
+    if app_core == 'reactor':
+        loop = reactor.Reactor()
+        print_spooler = spooler.TaskSpooler(loop, open_printer, print_message_steps,
+                                            max_print_jobs)
+        app = ReactorApplication(loop, ui_thread, display)
+    else:
+        app = AdvisorApplication(ui_thread, display)
     try:
-        AdvisorApplication(ui_thread, display).run()
+        app.run()
     finally:
         display.clear()
         display.noBacklight()
 
         
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Dispense wisdom for small change.')
+    parser.add_argument('--serve', action='store_true',
+                        help='render receipts for other kiosks on render_socket, '
+                        'instead of running the machine')
+    args = parser.parse_args()
+    if args.serve:
+        serve(render_socket)
+    else:
+        main()
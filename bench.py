@@ -0,0 +1,204 @@
+#!/usr/bin/python
+"""Benchmarks the fortune and display hot paths.
+
+Usage: bench.py [-t SECONDS] [-k PATTERN] [-o results.json] [-c baseline.json]
+
+Fortunes are read from the databases configured in advisor.py. Display
+benchmarks run against hwsim.SMBus without its sleeps, and report I2C
+transactions, bytes and modelled bus time per call.
+"""
+
+import argparse
+import functools
+import gc
+import itertools
+import json
+import platform
+import random
+import time
+
+import Adafruit_CharLCD
+import advisor
+import hwsim
+import wrapping
+
+class Benchmark(object):
+    """A function to time.
+
+    Arguments:
+      name: Name in the results.
+      func: Function to call with no arguments.
+      counters: Function returning a dict of running totals, such as I2C
+        transactions, which are reported per call.
+    """
+
+    def __init__(self, name, func, counters=None):
+        self.name = name
+        self.func = func
+        self.counters = counters
+
+def _cycle(items):
+    return functools.partial(next, itertools.cycle(items))
+
+def fortune_benchmarks(samples=200):
+    rng = random.Random(0)
+    dbs = [db for value, tier in advisor.databases for db in tier if db.numstr]
+    picks = [(db, rng.randrange(db.numstr)) for db in dbs for i in range(samples)]
+    rng.shuffle(picks)
+    next_pick = _cycle(picks)
+    next_db = _cycle(dbs)
+
+    def read():
+        db, index = next_pick()
+        db.read(index)
+    yield Benchmark('strfile.read', read)
+    yield Benchmark('strfile.read_random', lambda: next_db().read_random())
+
+    for value, tier in advisor.databases:
+        # The budget generate_fortunes() gives the first fortune.
+        yield Benchmark('pick_within[%d]' % value,
+                        functools.partial(advisor.fortune_sampler.pick_within, value,
+                                          advisor.print_lines_budget(value) - 2))
+
+    next_text = _cycle([db.read(index) for db, index in picks])
+    yield Benchmark('unwrap+wrap', lambda: wrapping.wrap(wrapping.unwrap(next_text())))
+
+    # Warm runs mostly find the fortunes already wrapped in render_cache;
+    # cold ones empty it first, as for the first receipts after a start.
+    def generate_cold(value):
+        advisor.render_cache.clear()
+        advisor.generate_wisdom(value)
+    for value in sorted(set(advisor.coin_values.itervalues())):
+        yield Benchmark('generate_wisdom[%d]/cold' % value,
+                        functools.partial(generate_cold, value))
+        yield Benchmark('generate_wisdom[%d]/warm' % value,
+                        functools.partial(advisor.generate_wisdom, value))
+
+def display_benchmarks():
+    bus = hwsim.SMBus(sleep_func=lambda seconds: None)
+    display = Adafruit_CharLCD.Adafruit_I2C_CharLCD(bus, advisor.display_address)
+    display.begin(16, 2)
+    display.clear()
+
+    def counters():
+        return {'i2c_transactions': bus.transactions, 'i2c_bytes': bus.bytes,
+                'i2c_seconds': bus.busy_time}
+
+    next_message = _cycle(['Insert coins for\nwisdom!', 'Your wisdom is\nprinting...'])
+    def message():
+        display.setCursor(0, 0)
+        display.message(next_message())
+    yield Benchmark('lcd.message', message, counters)
+
+    # A balance changing, as when coins go in, then a whole new screen.
+    next_screen = _cycle([['Total:    ' + advisor.lcd_currency_symbol + '0.20', 'Green to print'],
+                          ['Total:    ' + advisor.lcd_currency_symbol + '0.70', 'Green to print'],
+                          ['Printing...', 'Please wait']])
+    yield Benchmark('lcd.render', lambda: display.render(next_screen()), counters)
+
+def time_calls(func, min_time):
+    """Calls func in ever larger batches until one takes min_time seconds.
+
+    Returns:
+      The number of calls in the last batch and how long it took.
+    """
+    calls = 1
+    while True:
+        start = time.time()
+        for i in xrange(calls):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return calls, elapsed
+        calls *= 2
+
+def count_allocations(func, calls):
+    """Returns how many objects calls to func leave to the garbage collector, per call.
+
+    With the collector off, its count of tracked objects goes up for each
+    container allocated and down for each freed. So this counts containers
+    a call keeps, such as new cache entries, or leaves in reference cycles;
+    temporaries freed before it returns, and strings, don't show.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for i in xrange(calls):
+            func()
+        allocated = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return {'gc_objects_per_call': float(allocated) / calls}
+
+def run(benchmark, min_time, repeat, seed):
+    random.seed(seed)
+    benchmark.func()
+    before = benchmark.counters() if benchmark.counters else {}
+    best = None
+    total_calls = 0
+    for i in range(repeat):
+        calls, elapsed = time_calls(benchmark.func, min_time)
+        if best is None or calls / elapsed > best[0] / best[1]:
+            best = calls, elapsed
+        total_calls += calls
+    calls, elapsed = best
+    result = {'ops_per_second': calls / elapsed, 'calls': calls, 'seconds': elapsed}
+    if benchmark.counters:
+        after = benchmark.counters()
+        for name, value in after.iteritems():
+            result[name + '_per_call'] = float(value - before[name]) / total_calls
+    result.update(count_allocations(benchmark.func, min(calls, 1000)))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the fortune and display hot paths.')
+    parser.add_argument('-t', dest='min_time', type=float, default=0.2,
+                        help='shortest timed run, in seconds (default 0.2)')
+    parser.add_argument('-r', dest='repeat', type=int, default=3,
+                        help='timed runs per benchmark; the best is kept (default 3)')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run benchmarks whose names contain this')
+    parser.add_argument('-s', dest='seed', type=int, default=0,
+                        help='random seed (default 0)')
+    parser.add_argument('-o', dest='output', help='save the results to this JSON file')
+    parser.add_argument('-c', dest='baseline',
+                        help='compare against results saved by an earlier run')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+    results = {}
+    for benchmark in itertools.chain(fortune_benchmarks(), display_benchmarks()):
+        if args.pattern not in benchmark.name:
+            continue
+        result = results[benchmark.name] = run(benchmark, args.min_time,
+                                               args.repeat, args.seed)
+        line = '%-28s %12.1f ops/s %8.2f gc objs/call' % (
+            benchmark.name, result['ops_per_second'], result['gc_objects_per_call'])
+        if 'i2c_transactions_per_call' in result:
+            line += ' %6.1f i2c/call' % result['i2c_transactions_per_call']
+        if benchmark.name in baseline:
+            line += ' %+7.1f%%' % (100.0 * (result['ops_per_second'] /
+                                            baseline[benchmark.name]['ops_per_second'] - 1))
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'node': platform.node(),
+                'min_time': args.min_time,
+                'repeat': args.repeat,
+                'seed': args.seed,
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
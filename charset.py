@@ -0,0 +1,151 @@
+"""Encoding Unicode text for HD44780 displays, with custom glyphs in CGRAM."""
+
+import collections
+
+# Characters of the A00 (Japanese) character ROM, the most common one, that
+# aren't at their ASCII positions. Backslash and tilde are missing from it.
+A00 = dict((code, code) for code in range(0x20, 0x7E) if code != 0x5C)
+A00.update({
+    0x00A5: 0x5C, # yen sign
+    0x2192: 0x7E, # rightwards arrow
+    0x2190: 0x7F, # leftwards arrow
+    0x00B7: 0xA5, # middle dot
+    0x00B0: 0xDF, # degree sign
+    0x03B1: 0xE0, # alpha
+    0x00E4: 0xE1, # a umlaut
+    0x03B2: 0xE2, # beta
+    0x03B5: 0xE3, # epsilon
+    0x03BC: 0xE4, # mu
+    0x00B5: 0xE4, # micro sign
+    0x03C3: 0xE5, # sigma
+    0x03C1: 0xE6, # rho
+    0x221A: 0xE8, # square root
+    0x00A2: 0xEC, # cent sign
+    0x00F1: 0xEE, # n tilde
+    0x00F6: 0xEF, # o umlaut
+    0x03B8: 0xF2, # theta
+    0x221E: 0xF3, # infinity
+    0x03A9: 0xF4, # omega
+    0x00FC: 0xF5, # u umlaut
+    0x03A3: 0xF6, # capital sigma
+    0x03C0: 0xF7, # pi
+    0x5343: 0xFA, # thousand
+    0x4E07: 0xFB, # ten thousand
+    0x5186: 0xFC, # yen
+    0x00F7: 0xFD, # division sign
+    0x2588: 0xFF, # full block
+})
+# Halfwidth katakana and punctuation.
+A00.update((0xFF61 + i, 0xA1 + i) for i in range(0x3F))
+
+# 5x8 bitmaps, top row first, for characters to draw in CGRAM when the
+# ROM lacks them.
+GLYPHS = {
+    u'\u00a3': (0x06, 0x09, 0x08, 0x1E, 0x08, 0x08, 0x1F, 0x00), # pound sign
+    u'\u20ac': (0x07, 0x08, 0x1E, 0x08, 0x1E, 0x08, 0x07, 0x00), # euro sign
+    u'\u25b2': (0x00, 0x04, 0x0E, 0x1F, 0x00, 0x00, 0x00, 0x00), # up triangle
+    u'\u25bc': (0x00, 0x00, 0x00, 0x00, 0x1F, 0x0E, 0x04, 0x00), # down triangle
+    u'\\': (0x00, 0x10, 0x08, 0x04, 0x02, 0x01, 0x00, 0x00),
+    u'~': (0x00, 0x00, 0x08, 0x15, 0x02, 0x00, 0x00, 0x00),
+}
+
+# Encoded text holds ROM codes as the characters u'\x00' to u'\xff', and
+# glyphs as private use characters from GLYPH_BASE up.
+GLYPH_BASE = u'\ue000'
+# Never equal to an encoded character, for screen cells whose content is unknown.
+STALE = u'\uffff'
+
+class _Table(dict):
+    """A unicode.translate() table that maps unknown characters to missing."""
+
+    def __init__(self, missing):
+        super(_Table, self).__init__()
+        self.missing = missing
+
+    def __missing__(self, code):
+        self[code] = self.missing
+        return self.missing
+
+
+class Codec(object):
+    """Encodes text for a display, in one unicode.translate() pass.
+
+    Byte strings are taken to be ROM codes already, and are passed through.
+
+    Arguments:
+      rom: Dict from Unicode code points to the ROM codes that show them.
+      glyphs: Dict from characters to bitmaps, used for characters the ROM
+        doesn't have.
+      missing: Character to show for characters in neither.
+    """
+
+    def __init__(self, rom=A00, glyphs=GLYPHS, missing=u'?'):
+        self.missing = ord(missing)
+        self.table = _Table(self.missing)
+        self.table.update(rom)
+        # message() treats newline specially.
+        self.table[ord(u'\n')] = ord(u'\n')
+        self.bitmaps = {}
+        for i, (char, bitmap) in enumerate(sorted(glyphs.iteritems())):
+            if ord(char) not in rom:
+                cell = unichr(ord(GLYPH_BASE) + i)
+                self.table[ord(char)] = ord(cell)
+                self.bitmaps[cell] = bitmap
+
+    def encode(self, text):
+        if isinstance(text, str):
+            return text.decode('latin-1')
+        return text.translate(self.table)
+
+
+class GlyphCache(object):
+    """Tracks which glyphs are in a display's CGRAM slots.
+
+    A slot is only reused when a glyph that isn't loaded is needed, and then
+    it is the least recently used slot.
+    """
+
+    def __init__(self, slots=8):
+        # Loaded glyphs, least recently used first, mapped to their slots.
+        self.loaded = collections.OrderedDict()
+        self.free = range(slots)
+        self.uploads = 0
+
+    def slot(self, cell):
+        """Returns the slot glyph cell is in, or None."""
+        return self.loaded.get(cell)
+
+    def load(self, cells, protect=()):
+        """Makes sure the glyphs in cells are loaded.
+
+        Arguments:
+          cells: Glyphs needed now.
+          protect: Glyphs to keep loaded if possible, such as those on screen.
+        Returns:
+          A list of (slot, glyph) pairs to upload, and a list of the glyphs
+          they replace. If more glyphs are needed than there are slots, some
+          are left out.
+        """
+        uploads = []
+        evicted = []
+        for cell in cells:
+            slot = self.loaded.pop(cell, None)
+            if slot is not None:
+                self.loaded[cell] = slot
+        for cell in cells:
+            if cell in self.loaded:
+                continue
+            if self.free:
+                slot = self.free.pop(0)
+            else:
+                victims = ([loaded for loaded in self.loaded
+                            if loaded not in cells and loaded not in protect] or
+                           [loaded for loaded in self.loaded if loaded not in cells])
+                if not victims:
+                    break
+                slot = self.loaded.pop(victims[0])
+                evicted.append(victims[0])
+            self.loaded[cell] = slot
+            uploads.append((slot, cell))
+        self.uploads += len(uploads)
+        return uploads, evicted
@@ -0,0 +1,192 @@
+import collections
+import threading
+import ui
+
+class RejectedCoinEvent(ui.Event):
+    """Posted for a pulse train that couldn't be read as a coin."""
+
+    def __init__(self, now, count, reason, args):
+        super(RejectedCoinEvent, self).__init__(now)
+        self.count = count
+        self.reason = reason
+        self.args = args
+
+    def __repr__(self):
+        return "RejectedCoinEvent(%r, %r, %r, %r)" % (
+            self.now, self.count, self.reason, self.args)
+
+
+class EdgeRing(object):
+    """A fixed-size buffer of timestamped edges.
+
+    One thread push()es edges and another drain()s them. When the buffer is
+    full the oldest edge is dropped and counted in overflows.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = [0.0] * size
+        self.states = [False] * size
+        self.start = 0
+        self.count = 0
+        self.overflows = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def push(self, now, state):
+        with self.lock:
+            if self.count == self.size:
+                self.start = (self.start + 1) % self.size
+                self.count -= 1
+                self.overflows += 1
+            i = (self.start + self.count) % self.size
+            self.times[i] = now
+            self.states[i] = state
+            self.count += 1
+
+    def drain(self):
+        """Removes and returns the buffered edges as (time, state) pairs, oldest first."""
+        with self.lock:
+            edges = [(self.times[i % self.size], self.states[i % self.size])
+                     for i in range(self.start, self.start + self.count)]
+            self.start = (self.start + self.count) % self.size
+            self.count = 0
+        return edges
+
+
+class CoinPulseDecoder(object):
+    """Reads coin values from the pulse trains of a coin acceptor.
+
+    Edges are given to edge(), and edges that were over before the pin could
+    be read to missed(), usually by a gpioedge source. Both are kept in a
+    ring buffer until the UIEventGenerator polls the decoder. Pulses shorter
+    than min_width are ignored as noise. A train ends once the line has been
+    idle for max_gap; it produces an InputEvent with the pulse count if the
+    count is in valid_counts, and a RejectedCoinEvent otherwise, or if it had
+    a pulse longer than max_width, a gap shorter than min_gap, or lost edges.
+
+    Attributes:
+      counters: Running totals of 'glitches', 'long_pulses', 'short_gaps',
+        'missed_edges', 'overflows' and 'unknown_counts'.
+      accepted: Number of trains accepted, by pulse count.
+      rejected: Number of trains rejected, by pulse count.
+    """
+
+    def __init__(self, default_state, valid_counts, min_width, max_width,
+                 min_gap, max_gap, args='coin', ring_size=64, wake=None):
+        self.default_state = default_state
+        self.valid_counts = frozenset(valid_counts)
+        self.min_width = min_width
+        self.max_width = max_width
+        self.min_gap = min_gap
+        self.max_gap = max_gap
+        self.args = args
+        self.wake = wake
+        self.ring = EdgeRing(ring_size)
+        self.seen_overflows = 0
+
+        self.line_state = default_state
+        self.pulse_start = None
+        # The end of the last pulse that counted, for measuring gaps, and of
+        # the last pulse of any kind, for telling when a train is over.
+        self.last_end = None
+        self.last_release = None
+        self.pulse_count = 0
+        self.problem = None
+
+        self.counters = collections.Counter()
+        self.accepted = collections.Counter()
+        self.rejected = collections.Counter()
+
+    def edge(self, now, state):
+        self.ring.push(now, state)
+        if self.wake:
+            self.wake()
+
+    def missed(self, now):
+        # A state of None marks the miss in the ring.
+        self.ring.push(now, None)
+        if self.wake:
+            self.wake()
+
+    def __call__(self, now):
+        events = []
+        edges = self.ring.drain()
+        overflows = self.ring.overflows
+        if overflows != self.seen_overflows:
+            self.counters['overflows'] += overflows - self.seen_overflows
+            self.seen_overflows = overflows
+            self.problem = 'overflow'
+        for when, state in edges:
+            self._end_train(when, events)
+            if state is None:
+                self._missed(when)
+            else:
+                self._edge(when, state)
+        self._end_train(now, events)
+        return events
+
+    def next_poll(self, now):
+        if len(self.ring):
+            return 0
+        if self.pulse_start is None and self.last_release is not None:
+            return max(self.last_release + self.max_gap - now, 0)
+        return None
+
+    def _edge(self, when, state):
+        active = state != self.default_state
+        if active == (self.line_state != self.default_state):
+            # Two edges to the same level: one in between was lost.
+            self.counters['missed_edges'] += 1
+            self.problem = 'missed edge'
+        self.line_state = state
+        if active:
+            self.pulse_start = when
+        elif self.pulse_start is not None:
+            width = when - self.pulse_start
+            if width < self.min_width:
+                # Noise. Gaps are still measured from the last real pulse.
+                self.counters['glitches'] += 1
+                self.pulse_start = None
+                self.last_release = when
+                return
+            if width > self.max_width:
+                self.counters['long_pulses'] += 1
+                self.problem = 'long pulse'
+            if self.last_end is not None and self.pulse_start - self.last_end < self.min_gap:
+                self.counters['short_gaps'] += 1
+                self.problem = 'short gap'
+            self.pulse_count += 1
+            self.pulse_start = None
+            self.last_end = self.last_release = when
+
+    def _missed(self, when):
+        # A whole pulse may have been lost, so the train can't be trusted.
+        self.counters['missed_edges'] += 1
+        self.problem = 'missed edge'
+        if self.pulse_start is None:
+            self.last_release = when
+
+    def _end_train(self, now, events):
+        if self.pulse_start is not None or self.last_release is None:
+            return
+        if now - self.last_release <= self.max_gap:
+            return
+        count = self.pulse_count
+        reason = self.problem
+        if reason is None and count == 0:
+            pass # Nothing but noise.
+        elif reason is None and count not in self.valid_counts:
+            self.counters['unknown_counts'] += 1
+            reason = 'unknown count'
+        if reason is not None:
+            self.rejected[count] += 1
+            events.append(RejectedCoinEvent(now, count, reason, self.args))
+        elif count:
+            self.accepted[count] += 1
+            events.append(ui.InputEvent(now, count, self.args))
+        self.pulse_count = 0
+        self.problem = None
+        self.last_end = self.last_release = None
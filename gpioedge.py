@@ -0,0 +1,101 @@
+"""Sources of timestamped GPIO edges for ui.EdgeInputHandler and friends.
+
+Each source calls handler.edge(now, state) for every change of its pin, and
+handler.missed(now) for an edge after which the pin reads as it did before,
+because it changed back before it could be read.
+"""
+
+import threading
+import time
+
+class RPiEdgeSource(object):
+    """Reports edges on a pin using RPi.GPIO's interrupt callbacks.
+
+    The time is taken as soon as RPi.GPIO's callback thread runs, which is
+    as close to the interrupt as RPi.GPIO allows. By the time the pin is
+    read a short pulse may already be over. Then the pin reads the same as
+    the last reported state, and the edge is passed to handler.missed() and
+    counted in missed.
+
+    RPi.GPIO ignores the edges that follow one within bouncetime, the last
+    edge of a bounce among them, so the level read at the first may be left
+    standing. resample() reads the pin again once the bounce is over.
+
+    Arguments:
+      bouncetime: Milliseconds after an edge during which RPi.GPIO ignores
+        further edges, or None.
+    """
+
+    def __init__(self, gpio, pin, handler, initial_state, bouncetime=None,
+                 time_func=time.time):
+        self.gpio = gpio
+        self.pin = pin
+        self.handler = handler
+        self.state = initial_state
+        self.time_func = time_func
+        self.missed = 0
+        self.lock = threading.Lock()
+        kwargs = {'callback': self._callback}
+        if bouncetime:
+            kwargs['bouncetime'] = bouncetime
+        gpio.add_event_detect(pin, gpio.BOTH, **kwargs)
+
+    def resample(self, now):
+        """Reads the pin, and reports a change RPi.GPIO didn't call back for."""
+        with self.lock:
+            state = bool(self.gpio.input(self.pin))
+            if state != self.state:
+                self.state = state
+                self.handler.edge(now, state)
+
+    def _callback(self, channel):
+        now = self.time_func()
+        with self.lock:
+            state = bool(self.gpio.input(channel))
+            if state == self.state:
+                # The pin changed and changed back before it was read.
+                self.missed += 1
+                self.handler.missed(now)
+                return
+            self.state = state
+            self.handler.edge(now, state)
+
+    def close(self):
+        self.gpio.remove_event_detect(self.pin)
+
+
+class SimulatedEdgeSource(object):
+    """Feeds scripted edges to a handler, for tests and running off-device."""
+
+    def __init__(self, handler, initial_state, time_func=time.time):
+        self.handler = handler
+        self.state = initial_state
+        self.time_func = time_func
+
+    def set(self, state, now=None):
+        """Changes the simulated pin to state, at time now (default: the current time)."""
+        if now is None:
+            now = self.time_func()
+        if state != self.state:
+            self.state = state
+            self.handler.edge(now, state)
+
+    def miss(self, now=None):
+        """Reports an edge that was over before the simulated pin could be read."""
+        self.handler.missed(self.time_func() if now is None else now)
+
+    def pulse_train(self, count, width, gap, active_state, start=None):
+        """Sends count pulses of width seconds, gap seconds apart, starting at start.
+
+        Returns the time of the last edge.
+        """
+        now = self.time_func() if start is None else start
+        for i in range(count):
+            self.set(active_state, now)
+            now += width
+            self.set(not active_state, now)
+            now += gap
+        return now - gap
+
+    def close(self):
+        pass
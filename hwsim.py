@@ -0,0 +1,187 @@
+"""Simulated stand-ins for RPi.GPIO, smbus and pyserial, for running off-device.
+
+Each models how long the real hardware takes, so the application can be
+benchmarked and soak tested on an ordinary machine.
+"""
+
+import collections
+import Queue
+import threading
+import time
+
+class SMBus(object):
+    """Stands in for smbus.SMBus, remembering what was written to each register.
+
+    Every transfer sleeps for as long as it would take on a bus_hz I2C bus:
+    9 clocks for each byte, including the address bytes, plus a fixed
+    overhead for the start and stop conditions and the system call.
+    """
+
+    def __init__(self, bus=0, bus_hz=100000, overhead=0.0001, sleep_func=time.sleep):
+        self.bus = bus
+        self.bus_hz = bus_hz
+        self.overhead = overhead
+        self.sleep_func = sleep_func
+        self.registers = collections.defaultdict(dict)
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+
+    def _transfer(self, nbytes):
+        elapsed = self.overhead + 9.0 * nbytes / self.bus_hz
+        self.transactions += 1
+        self.bytes += nbytes
+        self.busy_time += elapsed
+        self.sleep_func(elapsed)
+
+    def write_byte_data(self, address, reg, value):
+        self._transfer(3)
+        self.registers[address][reg] = value
+
+    def read_byte_data(self, address, reg):
+        # Address and register, then a repeated start to read the value.
+        self._transfer(4)
+        return self.registers[address].get(reg, 0)
+
+    def write_i2c_block_data(self, address, reg, values):
+        self._transfer(2 + len(values))
+        # As for the MCP23008 with sequential addressing off, every byte goes
+        # to the same register.
+        if values:
+            self.registers[address][reg] = values[-1]
+
+    def close(self):
+        pass
+
+
+class Serial(object):
+    """Stands in for serial.Serial.
+
+    Writes go into a transmit buffer of tx_buffer bytes which drains at
+    baudrate, at 10 bits to the byte. Like a real port, write() only blocks
+    while the buffer is full and flush() waits for it to drain. The last
+    keep bytes written are kept in output.
+    """
+
+    def __init__(self, port=None, baudrate=9600, tx_buffer=4096, keep=65536,
+                 sleep_func=time.sleep, time_func=time.time):
+        self.port = port
+        self.baudrate = baudrate
+        self.tx_buffer = tx_buffer
+        self.keep = keep
+        self.sleep_func = sleep_func
+        self.time_func = time_func
+        self.output = bytearray()
+        self.bytes_written = 0
+        self.drained_at = 0.0
+
+    def _byte_time(self):
+        return 10.0 / self.baudrate
+
+    def write(self, data):
+        now = self.time_func()
+        self.drained_at = max(self.drained_at, now) + len(data) * self._byte_time()
+        # Block until what's left to send fits in the buffer.
+        excess = self.drained_at - now - self.tx_buffer * self._byte_time()
+        if excess > 0:
+            self.sleep_func(excess)
+        self.bytes_written += len(data)
+        self.output.extend(data)
+        del self.output[:-self.keep]
+        return len(data)
+
+    def flush(self):
+        remaining = self.drained_at - self.time_func()
+        if remaining > 0:
+            self.sleep_func(remaining)
+
+    def close(self):
+        self.flush()
+
+
+class GPIO(object):
+    """Stands in for the RPi.GPIO module.
+
+    Input levels are changed with set(), press() and pulse_train(). As with
+    RPi.GPIO, callbacks registered with add_event_detect() are called on a
+    separate thread, which reads the pin itself, so it may see a later level
+    than the edge that woke it. Inputs start high unless pulled down.
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, sleep_func=time.sleep):
+        self.sleep_func = sleep_func
+        self.mode = None
+        self.levels = {}
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.edges = Queue.Queue()
+        self.thread = threading.Thread(target=self._run_callbacks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+        with self.lock:
+            if initial is not None:
+                self.levels[pin] = int(bool(initial))
+            else:
+                self.levels.setdefault(pin, int(pull_up_down != self.PUD_DOWN))
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def output(self, pin, value):
+        self.set(pin, value)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def set(self, pin, level):
+        """Drives input pin to level, calling any callback for the edge."""
+        level = int(bool(level))
+        with self.lock:
+            if self.levels.get(pin) == level:
+                return
+            self.levels[pin] = level
+        edge, callback = self.callbacks.get(pin, (None, None))
+        if callback and edge in (self.BOTH, self.RISING if level else self.FALLING):
+            self.edges.put((callback, pin))
+
+    def press(self, pin, duration=0.1, active=LOW):
+        """Holds pin at active for duration seconds, as a button would."""
+        self.set(pin, active)
+        self.sleep_func(duration)
+        self.set(pin, not active)
+
+    def pulse_train(self, pin, count, width, gap, active=LOW):
+        """Sends count pulses of width seconds to pin, gap seconds apart."""
+        for i in range(count):
+            if i:
+                self.sleep_func(gap)
+            self.press(pin, width, active)
+
+    def _run_callbacks(self):
+        while True:
+            callback, pin = self.edges.get()
+            callback(pin)
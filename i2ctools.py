@@ -1,8 +1,19 @@
-def register_property(i2c, address, reg):
-  def _getter():
-    return i2c.read_byte_data(address, reg)
-  def _setter(values):
+def register_property(reg, cached=True):
+  """Returns a property for register reg of a device with read() and write().
+
+  Assigning an int writes it; assigning a sequence block-writes it. Reading
+  returns the last value written if cached is true and one is known, and
+  reads the device otherwise.
+  """
+  def _getter(self):
+    if cached:
+      value = self.cached(reg)
+      if value is not None:
+        return value
+    return self.read(reg)
+  def _setter(self, values):
     if isinstance(values, (int, long)):
-      values = (values,)
-    i2c.write_block_data(address, reg, values)
+      self.write(reg, values)
+    else:
+      self.write_sequence(reg, values)
   return property(_getter, _setter)
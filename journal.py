@@ -0,0 +1,229 @@
+"""A crash-safe, append-only journal of state changes, fsynced in groups.
+
+Each record is one line holding a sequence number, the record's words and
+a CRC-32 of them. A crash can only tear the last line written, which
+replay spots and stops at. The state is written to a snapshot file from
+time to time, so the journal only has to keep the records since.
+"""
+
+import binascii
+import errno
+import os
+import threading
+import time
+
+SNAPSHOT_SUFFIX = '.snap'
+OLD_SUFFIX = '.old'
+
+def format_record(seq, words):
+    body = '%d %s' % (seq, ' '.join(str(word) for word in words))
+    return '%s %08x\n' % (body, binascii.crc32(body) & 0xffffffff)
+
+def parse_record(line):
+    """Returns the sequence number and words of line, or None if it is torn or corrupt."""
+    if not line.endswith('\n'):
+        return None
+    parts = line[:-1].rsplit(' ', 1)
+    if len(parts) != 2:
+        return None
+    body, crc = parts
+    try:
+        if int(crc, 16) != binascii.crc32(body) & 0xffffffff:
+            return None
+        words = body.split(' ')
+        return int(words[0]), words[1:]
+    except ValueError:
+        return None
+
+def read_records(path):
+    """Returns the (sequence number, words) records in path, up to the first bad one."""
+    records = []
+    try:
+        fh = open(path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return records
+        raise
+    with fh:
+        for line in fh:
+            record = parse_record(line)
+            if record is None:
+                break
+            records.append(record)
+    return records
+
+
+class Journal(object):
+    """Records state changes so they survive a crash, a power cut or kill -9.
+
+    append() only write()s, which costs little. A thread fsyncs everything
+    written commit_window seconds after the first record that isn't yet on
+    disk, so records that arrive together share one fsync; commit() asks
+    for one straight away. Neither waits for the fsync, so a crash loses at
+    most the last commit_window seconds of records.
+
+    Every compact_after records, the state is taken as a snapshot and a new
+    journal file started. The thread writes the snapshot and then deletes
+    the old journal file.
+
+    Records and snapshots are lists of words: strings without spaces, or
+    numbers.
+
+    Arguments:
+      path: The journal file. The snapshot is kept in path + '.snap'.
+      commit_window: Seconds a record may wait for others to share its fsync.
+      compact_after: Number of records after which to snapshot.
+    """
+
+    def __init__(self, path, commit_window=0.05, compact_after=1000, time_func=time.time):
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.old_path = path + OLD_SUFFIX
+        self.commit_window = commit_window
+        self.compact_after = compact_after
+        self.time_func = time_func
+        self.seq = 0
+        self.fd = None
+        self.records = 0
+        self.snapshot_func = None
+        self.commit_at = None
+        # (sequence number, words, old journal fd) of a snapshot to write.
+        self.pending_snapshot = None
+        self.commits = 0
+        self.snapshots = 0
+        self.errors = 0
+        self._stop = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def recover(self):
+        """Reads what earlier runs left.
+
+        Returns:
+          The words of the latest snapshot, or None if there is none, and a
+          list of the words of each record after it, oldest first.
+        """
+        snapshot_seq, snapshot = 0, None
+        for seq, words in read_records(self.snapshot_path)[:1]:
+            snapshot_seq, snapshot = seq, words
+        # A crash while compacting can leave the records in two files.
+        records = read_records(self.old_path) + read_records(self.path)
+        self.seq = max([snapshot_seq] + [seq for seq, words in records])
+        return snapshot, [words for seq, words in records if seq > snapshot_seq]
+
+    def start(self, snapshot_func):
+        """Snapshots the recovered state, starts an empty journal and the commit thread.
+
+        The journal's directory is created if need be.
+
+        Arguments:
+          snapshot_func: Function returning the current state as a list of
+            words. It is called by append(), so it sees the state as of the
+            record just appended.
+        """
+        self.snapshot_func = snapshot_func
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._write_snapshot(self.seq, snapshot_func())
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0644)
+        if os.path.exists(self.old_path):
+            os.unlink(self.old_path)
+        self._sync_dir()
+        self.thread.start()
+
+    def stop(self):
+        """Commits any records not yet on disk and stops the commit thread."""
+        with self.cond:
+            self._stop = True
+            if self.commit_at is not None:
+                self.commit_at = self.time_func()
+            self.cond.notify()
+        self.thread.join()
+        os.close(self.fd)
+
+    def append(self, words, commit=False):
+        """Adds a record, which reaches the disk within commit_window seconds.
+
+        Make the change to the state before recording it. With commit set,
+        the record is committed straight away, without waiting for others.
+        """
+        with self.cond:
+            self.seq += 1
+            os.write(self.fd, format_record(self.seq, words))
+            self.records += 1
+            if self.records >= self.compact_after and self.pending_snapshot is None:
+                self._rotate()
+                commit = True
+            if commit:
+                self.commit_at = self.time_func()
+                self.cond.notify()
+            elif self.commit_at is None:
+                self.commit_at = self.time_func() + self.commit_window
+                self.cond.notify()
+
+    def commit(self):
+        """Asks for the records so far to be fsynced now, without waiting for it."""
+        with self.cond:
+            self.commit_at = self.time_func()
+            self.cond.notify()
+
+    def _rotate(self):
+        # Records from here on go to a new file, so the snapshot can be
+        # written and the old file dropped without holding up append().
+        os.rename(self.path, self.old_path)
+        old_fd = self.fd
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0644)
+        self.pending_snapshot = (self.seq, self.snapshot_func(), old_fd)
+        self.records = 0
+
+    def _write_snapshot(self, seq, words):
+        tmp_path = self.snapshot_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.write(fd, format_record(seq, words))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, self.snapshot_path)
+        self._sync_dir()
+        self.snapshots += 1
+
+    def _sync_dir(self):
+        # Makes renames and new files in the directory durable.
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.commit_at is None and not self._stop:
+                    self.cond.wait()
+                if self.commit_at is None:
+                    return
+                delay = self.commit_at - self.time_func()
+                if delay > 0 and not self._stop:
+                    # Wait for the window to close, or for commit().
+                    self.cond.wait(delay)
+                    continue
+                self.commit_at = None
+                fd = self.fd
+                snapshot = self.pending_snapshot
+            try:
+                os.fsync(fd)
+                if snapshot:
+                    seq, words, old_fd = snapshot
+                    os.fsync(old_fd)
+                    # Also makes the new journal file's name durable.
+                    self._write_snapshot(seq, words)
+                    os.unlink(self.old_path)
+                    os.close(old_fd)
+                    with self.cond:
+                        self.pending_snapshot = None
+                self.commits += 1
+            except OSError:
+                self.errors += 1
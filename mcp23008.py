@@ -1,6 +1,11 @@
 import i2ctools
 
 class Expander(object):
+  """MCP23008 I/O expander that remembers what it has written.
+
+  Writes that would not change a register are skipped, and update() can
+  change bits without reading the register back over the bus.
+  """
   MCP_IODIR     = 0x00
   MCP_IPOL      = 0x01
   MCP_GPINTEN   = 0x02
@@ -13,9 +18,64 @@ class Expander(object):
   MCP_GPIO      = 0x09
   MCP_OLAT      = 0x0A
 
+  # Registers that only change when written. GPIO reads return the pins, so
+  # writes to it are remembered as OLAT.
+  SHADOWED = (MCP_IODIR, MCP_IPOL, MCP_GPINTEN, MCP_DEFVAL, MCP_INTCON,
+              MCP_IOCON, MCP_GPPU, MCP_OLAT)
+
   def __init__(self, i2c, address):
     self.i2c = i2c
     self.address = address
-    self.iodir = i2ctools.register_property(i2c, address, Expander.MCP_IODIR)
-    self.iocon = i2ctools.register_property(i2c, address, Expander.MCP_IOCON)
-    self.gpio = i2ctools.register_property(i2c, address, Expander.MCP_GPIO)
+    self.transactions = 0
+    self.shadow = {}
+
+  iodir = i2ctools.register_property(MCP_IODIR)
+  iocon = i2ctools.register_property(MCP_IOCON)
+  gpio = i2ctools.register_property(MCP_GPIO, cached=False)
+  olat = i2ctools.register_property(MCP_OLAT)
+
+  def _shadow_reg(self, reg):
+    if reg == Expander.MCP_GPIO:
+      return Expander.MCP_OLAT
+    return reg
+
+  def cached(self, reg):
+    """Returns the remembered value of reg, or None if it isn't known."""
+    return self.shadow.get(self._shadow_reg(reg))
+
+  def invalidate(self):
+    """Forgets all remembered values, e.g. after the chip has been reset."""
+    self.shadow.clear()
+
+  def read(self, reg):
+    value = self.i2c.read_byte_data(self.address, reg)
+    self.transactions += 1
+    if reg in Expander.SHADOWED:
+      self.shadow[reg] = value
+    return value
+
+  def write(self, reg, value):
+    """Writes value to reg, unless reg is known to hold it already."""
+    if self.cached(reg) == value:
+      return
+    self.i2c.write_byte_data(self.address, reg, value)
+    self.transactions += 1
+    self.shadow[self._shadow_reg(reg)] = value
+
+  def write_sequence(self, reg, values):
+    """Writes several values in one block transfer.
+
+    With IOCON.SEQOP set the address doesn't advance, so every value goes to
+    reg in turn; this is how the LCDs toggle their enable line.
+    """
+    values = list(values)
+    self.i2c.write_i2c_block_data(self.address, reg, values)
+    self.transactions += 1
+    self.shadow[self._shadow_reg(reg)] = values[-1]
+
+  def update(self, reg, set_bits=0, clear_bits=0):
+    """Sets and clears bits of reg, reading it first only if it isn't known."""
+    value = self.cached(reg)
+    if value is None:
+      value = self.read(self._shadow_reg(reg))
+    self.write(reg, (value & ~clear_bits) | set_bits)
@@ -0,0 +1,184 @@
+"""In-process metrics, exported in the Prometheus text format."""
+
+import bisect
+import os
+import threading
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in pairs)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = registry.lock
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        with self.lock:
+            samples = sorted(self.values.items())
+        for key, value in samples:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.label_names, key),
+                             _format_value(value))]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Callback(Metric):
+    """A metric whose single value is read from func() at export time."""
+
+    def __init__(self, registry, name, help, type, func):
+        super(Callback, self).__init__(registry, name, help)
+        self.TYPE = type
+        self.func = func
+
+    def expose(self):
+        self.values = {(): self.func()}
+        return super(Callback, self).expose()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, registry, name, help, buckets, labels=()):
+        super(Histogram, self).__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, then the overflow count and the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self, key, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.label_names, key, [('le', _format_value(bound))]),
+                total))
+        labels = _format_labels(self.label_names, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._add(Histogram(self, name, help, buckets, labels))
+
+    def callback(self, name, help, type, func):
+        return self._add(Callback(self, name, help, type, func))
+
+    def expose(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+class TextfileExporter(object):
+    """Writes a registry to a file for node_exporter's textfile collector.
+
+    The file is rewritten at most once per interval, and only if its
+    contents would change, to keep SD card writes down. Each write goes to
+    a temporary file that is renamed into place.
+    """
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.last_text = None
+        self.writes = 0
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        try:
+            self.export()
+        except (IOError, OSError):
+            pass
+
+    def export(self):
+        text = self.registry.expose()
+        if text == self.last_text:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            fh.write(text)
+        os.rename(tmp_path, self.path)
+        self.last_text = text
+        self.writes += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except (IOError, OSError):
+                pass
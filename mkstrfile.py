@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""Builds strfile(1) compatible .dat indexes for fortune files.
+
+Also writes a length index, fortunefile.len, holding the printed line count
+of each fortune.
+
+Usage: mkstrfile.py [-x] [-c DELIM] [-u] [-w WIDTH] fortunefile [datfile]
+"""
+
+import argparse
+import array
+import os
+import struct
+
+import strfile
+import wrapping
+
+VERSION = 1
+FLAG_RANDOM = strfile.Strfile.FLAG_RANDOM
+FLAG_ORDERED = strfile.Strfile.FLAG_ORDERED
+FLAG_ROTATED = strfile.Strfile.FLAG_ROTATED
+
+HEADER_FORMAT = '!LLLLLc3x'
+# Printer width the length index is counted at.
+DEFAULT_WIDTH = 32
+MAX_LENGTH = 0xFFFF
+
+class Index(object):
+    """The header fields and offset table of a strfile index.
+
+    offsets holds numstr + 1 entries; the last is where the scan that built
+    the index stopped, which is the end of the data file at the time.
+    """
+
+    def __init__(self, delim='%', flags=0):
+        self.version = VERSION
+        self.longlen = 0
+        self.shortlen = 0
+        self.flags = flags
+        self.delim = delim
+        self.offsets = array.array('L', [0])
+
+    @property
+    def numstr(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def load(cls, idx_path):
+        with open(idx_path, 'rb') as fh:
+            version, numstr, longlen, shortlen, flags, delim = struct.unpack(
+                HEADER_FORMAT, fh.read(strfile.Strfile.HEADER_LEN))
+            table = fh.read(4 * (numstr + 1))
+        index = cls(delim, flags)
+        index.version = version
+        index.longlen = longlen
+        index.shortlen = shortlen
+        index.offsets = array.array('L', struct.unpack('!%dL' % (len(table) // 4), table))
+        return index
+
+    def save(self, idx_path):
+        """Writes the index to a temporary file and renames it into place."""
+        tmp_path = idx_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(struct.pack(HEADER_FORMAT, self.version, self.numstr,
+                                 self.longlen, self.shortlen, self.flags,
+                                 self.delim))
+            fh.write(struct.pack('!%dL' % len(self.offsets), *self.offsets))
+        os.rename(tmp_path, idx_path)
+
+    def scan(self, data_fh):
+        """Indexes the data from the last offset to the end of data_fh.
+
+        Empty fortunes, from runs of delimiter lines, are skipped.
+        """
+        delim_line = self.delim + '\n'
+        offsets = self.offsets
+        pos = start = offsets[-1]
+        data_fh.seek(start)
+        for line in data_fh:
+            if line == delim_line:
+                if pos > start:
+                    self._add_length(pos - start)
+                    offsets.append(pos + len(line))
+                else:
+                    offsets[-1] = pos + len(line)
+                start = pos + len(line)
+            pos += len(line)
+        if pos > start:
+            # The last fortune has no trailing delimiter.
+            self._add_length(pos - start)
+            offsets.append(pos)
+
+    def _add_length(self, length):
+        if self.numstr == 0 or length > self.longlen:
+            self.longlen = length
+        if self.numstr == 0 or length < self.shortlen:
+            self.shortlen = length
+
+
+def _ends_with_delim(data_fh, index):
+    """Returns whether the indexed data ends with a delimiter line."""
+    delim_line = index.delim + '\n'
+    end = index.offsets[-1]
+    if end < len(delim_line):
+        return end == 0
+    data_fh.seek(end - len(delim_line) - 1)
+    tail = data_fh.read(len(delim_line) + 1)
+    return tail[1:] == delim_line and (end == len(delim_line) or tail[0] == '\n')
+
+def build_lengths(data_path, idx_path, width, known=()):
+    """Writes the length index for a fortune file and its new index.
+
+    Arguments:
+      known: Line counts already known for the first fortunes.
+    """
+    lengths = array.array('H', known)
+    with open(data_path, 'rb') as data_fh, open(idx_path, 'rb') as idx_fh:
+        db = strfile.Strfile(data_fh, idx_fh)
+        for num in xrange(len(lengths), db.numstr):
+            count = len(wrapping.wrap(wrapping.unwrap(db.read(num)), width))
+            lengths.append(min(count, MAX_LENGTH))
+    len_path = data_path + strfile.LENGTHS_SUFFIX
+    tmp_path = len_path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(struct.pack(strfile.LENGTHS_HEADER_FORMAT, strfile.LENGTHS_VERSION,
+                             len(lengths), width))
+        fh.write(struct.pack('!%dH' % len(lengths), *lengths))
+    os.rename(tmp_path, len_path)
+
+def build(data_path, idx_path=None, delim='%', rotated=False, width=DEFAULT_WIDTH):
+    """Indexes a fortune file from scratch.
+
+    Arguments:
+      data_path: The fortune file.
+      idx_path: Where to write the index. Defaults to data_path + '.dat'.
+      delim: The delimiter character.
+      rotated: Set the rot13 flag, for files whose text is rot13 encoded.
+      width: Width to count printed lines at for the length index.
+    Returns:
+      The new Index.
+    """
+    if idx_path is None:
+        idx_path = data_path + '.dat'
+    index = Index(delim, FLAG_ROTATED if rotated else 0)
+    with open(data_path, 'rb') as data_fh:
+        index.scan(data_fh)
+    index.save(idx_path)
+    build_lengths(data_path, idx_path, width)
+    return index
+
+def update(data_path, idx_path=None, delim='%', rotated=False, width=DEFAULT_WIDTH):
+    """Extends an existing index to cover text appended to a fortune file.
+
+    Only the bytes added since the index was built are scanned. If the old
+    text ended without a delimiter, its last fortune is rescanned as well.
+    Falls back to build() if there is no index, its delimiter differs, the
+    file has shrunk, the index was shuffled or sorted (strfile -r or -o), or
+    an unterminated last fortune was the shortest one.
+    The length index is likewise only extended, if it matches the old index.
+    """
+    if idx_path is None:
+        idx_path = data_path + '.dat'
+    try:
+        index = Index.load(idx_path)
+    except (IOError, struct.error):
+        return build(data_path, idx_path, delim, rotated, width)
+    if index.delim != delim or os.path.getsize(data_path) < index.offsets[-1]:
+        return build(data_path, idx_path, delim, rotated, width)
+    if index.flags & (FLAG_RANDOM | FLAG_ORDERED):
+        # Only a table in file order can be extended.
+        return build(data_path, idx_path, delim, rotated, width)
+    if rotated:
+        index.flags |= FLAG_ROTATED
+    lengths = strfile.read_lengths(data_path + strfile.LENGTHS_SUFFIX, width)
+    if lengths is None or len(lengths) != index.numstr:
+        lengths = ()
+    with open(data_path, 'rb') as data_fh:
+        if index.numstr and not _ends_with_delim(data_fh, index):
+            offsets = index.offsets
+            if offsets[-1] - offsets[-2] <= index.shortlen:
+                return build(data_path, idx_path, delim, rotated, width)
+            offsets.pop()
+        # Fortunes before this are unchanged.
+        lengths = lengths[:index.numstr]
+        index.scan(data_fh)
+    index.save(idx_path)
+    build_lengths(data_path, idx_path, width, lengths)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build a strfile(1) compatible index for a fortune file.')
+    parser.add_argument('data_path', metavar='fortunefile')
+    parser.add_argument('idx_path', metavar='datfile', nargs='?')
+    parser.add_argument('-c', dest='delim', default='%',
+                        help='delimiter character (default %%)')
+    parser.add_argument('-x', dest='rotated', action='store_true',
+                        help='set the rot13 flag')
+    parser.add_argument('-u', dest='incremental', action='store_true',
+                        help='only index text appended since the last build')
+    parser.add_argument('-w', dest='width', type=int, default=DEFAULT_WIDTH,
+                        help='printer width for the length index (default %d)'
+                        % DEFAULT_WIDTH)
+    args = parser.parse_args()
+    func = update if args.incremental else build
+    index = func(args.data_path, args.idx_path, args.delim, args.rotated, args.width)
+    print '"%s" created' % (args.idx_path or args.data_path + '.dat')
+    print 'There were %d strings' % index.numstr
+    print 'Longest string: %d bytes' % index.longlen
+    print 'Shortest string: %d bytes' % index.shortlen
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import threading
+
+class Pregenerator(object):
+    """Generates results ahead of time on a worker thread.
+
+    A result is only handed out for the value it was generated for.
+
+    Arguments:
+      generate: Function from a value to its result.
+    """
+
+    def __init__(self, generate):
+        self.generate = generate
+        self.values = set()
+        self.wanted = set()
+        self.ready = {}
+        self.hits = 0
+        self.misses = 0
+        self._stop = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self._stop = True
+            self.cond.notify()
+        self.thread.join()
+
+    def prepare(self, values):
+        """Sets the values to have results ready for.
+
+        Ready results for other values are dropped.
+        """
+        with self.cond:
+            self.values = set(values)
+            for value in self.ready.keys():
+                if value not in self.values:
+                    del self.ready[value]
+            self.wanted = set(value for value in self.values if value not in self.ready)
+            self.cond.notify()
+
+    def take(self, value):
+        """Returns a result for value, generating one now if none is ready.
+
+        A result is only handed out once; the worker then generates a
+        replacement if the value is still wanted.
+        """
+        with self.cond:
+            result = self.ready.pop(value, None)
+            if value in self.values:
+                self.wanted.add(value)
+                self.cond.notify()
+        if result is None:
+            self.misses += 1
+            return self.generate(value)
+        self.hits += 1
+        return result
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.wanted and not self._stop:
+                    self.cond.wait()
+                if self._stop:
+                    return
+                value = self.wanted.pop()
+            result = self.generate(value)
+            with self.cond:
+                if value in self.values:
+                    self.ready[value] = result
@@ -0,0 +1,261 @@
+"""A single-threaded event loop with timers, file readers and tasks.
+
+This is the core of asyncio cut down for Python 2. A task is a generator,
+which yields whatever it is waiting for:
+
+  yield 0.5             sleeps for half a second.
+  yield channel.get()   waits for an item to be put on a Channel, and
+                        evaluates to it.
+  yield task            waits for another Task to finish, and evaluates to
+                        its result, or raises its exception.
+
+A generator can't return a value on Python 2, so a task finishes with one
+by raising StopIteration(value).
+"""
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import time
+
+class Timer(object):
+    """A callback due at a time, as returned by Reactor.call_at()."""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor(object):
+    """Runs callbacks when timers expire and file descriptors become readable.
+
+    Everything runs on the thread that calls run(), which is the only thread
+    that may use the reactor, except through call_soon_threadsafe().
+    """
+
+    def __init__(self, time_func=time.time):
+        self.time_func = time_func
+        self.ready = collections.deque()
+        self.timers = []
+        self.readers = {}
+        self.seq = itertools.count()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in self._wake_r, self._wake_w:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._stop = False
+
+    def time(self):
+        return self.time_func()
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Like call_soon(), but may be called from any thread."""
+        # deque.append is atomic, so only the sleeping loop needs waking.
+        self.ready.append((callback, args))
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError as e:
+            # A full pipe will wake the loop anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def call_at(self, when, callback, *args):
+        """Calls callback(*args) at time when. Returns a Timer that can cancel it."""
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, (when, next(self.seq), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time_func() + delay, callback, *args)
+
+    def add_reader(self, fd, callback, *args):
+        """Calls callback(*args) whenever fd is readable, until remove_reader(fd)."""
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def spawn(self, generator):
+        """Starts running generator as a Task on the next pass of the loop."""
+        return Task(self, generator)
+
+    def run(self, until=None):
+        """Runs the loop until stop() is called, or until Task until is done.
+
+        An exception from a callback, or from a task nobody is waiting for,
+        stops the loop and is raised here.
+        """
+        self._stop = False
+        while not self._stop and not (until and until.done):
+            self._run_once()
+
+    def stop(self):
+        self._stop = True
+
+    def _run_once(self):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(self.timers[0][0] - self.time_func(), 0)
+        else:
+            timeout = None
+        try:
+            readable = select.select([self._wake_r] + self.readers.keys(), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        for fd in readable:
+            if fd == self._wake_r:
+                self._clear_wake()
+            elif fd in self.readers:
+                self.ready.append(self.readers[fd])
+        now = self.time_func()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                self.ready.append((timer.callback, timer.args))
+        # Callbacks added while these run wait for the next pass, so timers
+        # and readers aren't starved.
+        for i in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            callback(*args)
+
+    def _clear_wake(self):
+        try:
+            while os.read(self._wake_r, 512):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class Task(object):
+    """Runs a generator on a Reactor, resuming it when what it yielded is ready.
+
+    Attributes:
+      done: Whether the generator has finished.
+      result: What it finished with, if anything.
+      error: The exception it raised, or None.
+    """
+
+    def __init__(self, reactor, generator):
+        self.reactor = reactor
+        self.generator = generator
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiters = []
+        self.timer = None
+        self.channel = None
+        reactor.call_soon(self._step, None, None)
+
+    def cancel(self):
+        """Stops the task where it is waiting. Its waiters are resumed with None."""
+        if self.done:
+            return
+        if self.timer:
+            self.timer.cancel()
+        if self.channel:
+            self.channel.waiters.remove(self)
+        self.generator.close()
+        self._finish(None, None)
+
+    def _step(self, value, error):
+        if self.done:
+            return
+        self.timer = self.channel = None
+        try:
+            if error is not None:
+                waiting_on = self.generator.throw(error)
+            else:
+                waiting_on = self.generator.send(value)
+        except StopIteration as e:
+            self._finish(e.args[0] if e.args else None, None)
+            return
+        except Exception as e:
+            if not self.waiters:
+                self.done = True
+                self.error = e
+                raise
+            self._finish(None, e)
+            return
+        except BaseException as e:
+            # SystemExit or KeyboardInterrupt ends the task as well as the loop.
+            self._finish(None, e)
+            raise
+        if isinstance(waiting_on, (int, float)):
+            self.timer = self.reactor.call_later(waiting_on, self._step, None, None)
+        elif isinstance(waiting_on, _Get):
+            waiting_on.channel._wait(self)
+        elif isinstance(waiting_on, Task):
+            if waiting_on.done:
+                self.reactor.call_soon(self._step, waiting_on.result, waiting_on.error)
+            else:
+                waiting_on.waiters.append(self)
+        else:
+            self.reactor.call_soon(self._step, None,
+                                   TypeError('task yielded %r' % (waiting_on,)))
+
+    def _finish(self, result, error):
+        self.done = True
+        self.result = result
+        self.error = error
+        for waiter in self.waiters:
+            self.reactor.call_soon(waiter._step, result, error)
+        self.waiters = []
+
+
+class _Get(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class Channel(object):
+    """A first in, first out queue of items for tasks to wait on.
+
+    Only the reactor's thread may put() items; other threads can use
+    reactor.call_soon_threadsafe(channel.put, item).
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.items = collections.deque()
+        self.waiters = collections.deque()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        if self.waiters:
+            task = self.waiters.popleft()
+            task.channel = None
+            self.reactor.call_soon(task._step, item, None)
+        else:
+            self.items.append(item)
+
+    def get(self):
+        """Returns what a task yields to wait for the next item."""
+        return _Get(self)
+
+    def get_nowait(self):
+        """Removes and returns the next item. Raises IndexError if there is none."""
+        return self.items.popleft()
+
+    def _wait(self, task):
+        if self.items:
+            self.reactor.call_soon(task._step, self.items.popleft(), None)
+        else:
+            task.channel = self
+            self.waiters.append(task)
@@ -0,0 +1,287 @@
+"""Serving rendered receipts to several kiosks over a Unix domain socket.
+
+One request per line, answered in order, so a client may send several
+requests before reading any answers:
+
+  RENDER <value>  ->  OK <server microseconds> <length>, then length bytes
+                      holding the receipt's lines joined by NULs.
+  STATS           ->  OK <requests> <mean microseconds> <max microseconds>
+
+Anything else gets ERR and a message.
+"""
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+SEPARATOR = '\0'
+MAX_REQUEST = 1024
+
+class RenderError(Exception):
+    pass
+
+
+class _ServerConnection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = ''
+        self.outbuf = []
+        self.closing = False
+
+
+class RenderServer(object):
+    """Answers render requests from many clients on one thread.
+
+    Arguments:
+      path: Path of the socket. A stale socket there is replaced.
+      render: Function from a value to a list of lines.
+      observe: Function called with the seconds taken by each request.
+    """
+
+    def __init__(self, path, render, observe=None, time_func=time.time, backlog=16):
+        self.path = path
+        self.render = render
+        self.observe = observe
+        self.time_func = time_func
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(backlog)
+        self.listener.setblocking(0)
+        self.connections = {}
+        self.requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._stop = False
+
+    def serve_forever(self, poll_interval=0.5):
+        while not self._stop:
+            self.serve_once(poll_interval)
+
+    def stop(self):
+        self._stop = True
+
+    def serve_once(self, timeout):
+        """Waits up to timeout seconds for sockets to be ready, and serves them."""
+        writers = [fd for fd, conn in self.connections.iteritems() if conn.outbuf]
+        try:
+            readable, writable, _ = select.select(
+                [self.listener.fileno()] + self.connections.keys(), writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            if fd == self.listener.fileno():
+                self._accept()
+            elif fd in self.connections:
+                self._read(self.connections[fd])
+        for fd in writable:
+            # The connection may have been closed while reading.
+            if fd in self.connections:
+                self._write(self.connections[fd])
+
+    def close(self):
+        for conn in self.connections.values():
+            self._close(conn)
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(0)
+        conn = _ServerConnection(sock)
+        self.connections[conn.fd] = conn
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close(conn)
+            return
+        conn.inbuf += data
+        while '\n' in conn.inbuf:
+            line, conn.inbuf = conn.inbuf.split('\n', 1)
+            conn.outbuf.append(self._handle(line))
+        if len(conn.inbuf) > MAX_REQUEST:
+            conn.outbuf.append('ERR request too long\n')
+            conn.closing = True
+        # Most answers fit in the socket buffer, so try sending them now.
+        self._write(conn)
+
+    def _write(self, conn):
+        while conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf[0])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self._close(conn)
+                return
+            if sent < len(conn.outbuf[0]):
+                conn.outbuf[0] = conn.outbuf[0][sent:]
+                return
+            conn.outbuf.pop(0)
+        if conn.closing:
+            self._close(conn)
+
+    def _close(self, conn):
+        self.connections.pop(conn.fd, None)
+        conn.sock.close()
+
+    def _handle(self, line):
+        start = self.time_func()
+        words = line.split()
+        if words == ['STATS']:
+            mean = self.total_time / self.requests if self.requests else 0.0
+            return 'OK %d %d %d\n' % (self.requests, mean * 1e6, self.max_time * 1e6)
+        if len(words) != 2 or words[0] != 'RENDER':
+            return 'ERR bad request\n'
+        try:
+            value = int(words[1])
+        except ValueError:
+            return 'ERR bad value\n'
+        try:
+            body = SEPARATOR.join(self.render(value))
+        except Exception as e:
+            return 'ERR %s\n' % str(e).replace('\n', ' ')
+        elapsed = self.time_func() - start
+        self.requests += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if self.observe:
+            self.observe(elapsed)
+        return 'OK %d %d\n%s' % (elapsed * 1e6, len(body), body)
+
+
+class _ClientConnection(object):
+    def __init__(self, path, timeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class RenderClient(object):
+    """Fetches rendered receipts from a RenderServer.
+
+    Connections are kept open between calls, and shared between threads
+    through a pool of up to max_idle idle ones.
+
+    Attributes:
+      latencies: (server seconds, round trip seconds) for each receipt of
+        the last call.
+    """
+
+    def __init__(self, path, timeout=5.0, max_idle=2, time_func=time.time):
+        self.path = path
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.time_func = time_func
+        self.idle = []
+        self.lock = threading.Lock()
+        self.latencies = []
+
+    def render(self, value):
+        """Returns the receipt for value, as a list of lines."""
+        return self.render_many([value])[0]
+
+    def render_many(self, values):
+        """Returns receipts for several values, sending all the requests at once.
+
+        Raises socket.error if the server can't be reached, and RenderError
+        if it refuses a request.
+        """
+        start = self.time_func()
+        def read(conn):
+            receipts = []
+            latencies = []
+            for value in values:
+                words = self._read_header(conn)
+                if len(words) != 3:
+                    raise RenderError('bad answer: %r' % ' '.join(words))
+                body = conn.rfile.read(int(words[2]))
+                if len(body) != int(words[2]):
+                    raise socket.error(errno.ECONNRESET, 'connection closed')
+                receipts.append(body.split(SEPARATOR))
+                latencies.append((int(words[1]) / 1e6, self.time_func() - start))
+            return receipts, latencies
+        receipts, self.latencies = self._call(
+            ''.join('RENDER %d\n' % value for value in values), read)
+        return receipts
+
+    def stats(self):
+        """Returns the server's request count, and mean and max seconds taken."""
+        words = self._call('STATS\n', self._read_header)
+        return int(words[1]), int(words[2]) / 1e6, int(words[3]) / 1e6
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def _read_header(self, conn):
+        line = conn.rfile.readline(MAX_REQUEST)
+        if not line.endswith('\n'):
+            raise socket.error(errno.ECONNRESET, 'connection closed')
+        words = line.split()
+        if not words or words[0] != 'OK':
+            raise RenderError(line.strip())
+        return words
+
+    def _call(self, request, read):
+        """Sends request and returns read(connection).
+
+        A pooled connection may have been closed by the server since it was
+        last used, so if one fails, the request is tried once more on a new
+        connection.
+        """
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is not None:
+            try:
+                conn.sock.sendall(request)
+                result = read(conn)
+            except socket.error:
+                conn.close()
+                conn = None
+            except:
+                conn.close()
+                raise
+        if conn is None:
+            conn = _ClientConnection(self.path, self.timeout)
+            try:
+                conn.sock.sendall(request)
+                result = read(conn)
+            except:
+                conn.close()
+                raise
+        self._put(conn)
+        return result
+
+    def _put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
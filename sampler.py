@@ -0,0 +1,160 @@
+import bisect
+import math
+import random
+import threading
+
+class AliasTable(object):
+    """Walker's alias method: draws from a fixed discrete distribution in O(1)."""
+
+    def __init__(self, weights, random_func=random.random):
+        self.random_func = random_func
+        n = len(weights)
+        total = float(sum(weights))
+        if n == 0 or total <= 0:
+            raise ValueError("AliasTable needs at least one positive weight")
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = range(n)
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Anything left over is 1.0 up to rounding error.
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self):
+        u = self.random_func() * len(self.prob)
+        column = int(u)
+        if u - column < self.prob[column]:
+            return column
+        return self.alias[column]
+
+
+class FortuneSampler(object):
+    """Picks a (database, fortune number) pair for a value in constant time.
+
+    Tiers are the (value, dbs) pairs from advisor.databases: a value is served
+    by the first tier whose value is at least as large, or the last tier. The
+    alias table for each tier is built once, with each database weighted by
+    its fortune count times its entry in weights (1.0 when absent), so by
+    default every fortune in a tier is equally likely.
+    """
+
+    def __init__(self, tiers, weights=None, random_func=random.random):
+        weights = weights or {}
+        self.random_func = random_func
+        self.thresholds = [value for value, dbs in tiers]
+        self.tiers = []
+        for value, dbs in tiers:
+            dbs = tuple(db for db in dbs if db.numstr > 0)
+            table = AliasTable([db.numstr * weights.get(db.name, 1.0) for db in dbs],
+                               random_func)
+            self.tiers.append((dbs, table))
+        # Direct lookup from a whole-number value to its tier index.
+        self.tier_lookup = [bisect.bisect_left(self.thresholds, v)
+                            for v in range(int(self.thresholds[-1]) + 1)]
+
+    def tier(self, value):
+        """Returns the index of the tier that serves value."""
+        value = int(math.ceil(value))
+        if value >= len(self.tier_lookup):
+            return len(self.tiers) - 1
+        return self.tier_lookup[max(value, 0)]
+
+    def pick(self, value):
+        dbs, table = self.tiers[self.tier(value)]
+        db = dbs[table.draw()]
+        return db, int(self.random_func() * db.numstr)
+
+
+class BudgetSampler(FortuneSampler):
+    """A FortuneSampler that can also pick only fortunes that fit a budget.
+
+    Each database's fortune numbers are sorted by length, so the fortunes no
+    longer than a given length are a prefix of that order. For each tier
+    and each length in edges there is an alias table over those prefixes,
+    so a pick within a budget is as fast as an unconstrained one. Budgets
+    are rounded down to an edge, or to the longest fortune in the tier.
+
+    A tier's tables are built the first time it is picked from, as getting
+    the lengths may mean reading every fortune in its databases.
+
+    Arguments:
+      lengths: Function from a database to the length of each of its fortunes.
+      edges: Lengths to build tables for.
+    """
+
+    def __init__(self, tiers, lengths, edges, weights=None, random_func=random.random):
+        super(BudgetSampler, self).__init__(tiers, weights, random_func)
+        self.lengths = lengths
+        self.weights = weights or {}
+        self.edges = sorted(edges)
+        self.by_length = {}
+        self.sorted_lengths = {}
+        # For each tier, the length of its longest fortune, and for each
+        # edge below that, the (db, count) prefixes and a table to pick one.
+        self.longest = [None] * len(self.tiers)
+        self.budget_tables = [None] * len(self.tiers)
+        self.lock = threading.Lock()
+
+    def _sort_lengths(self, db):
+        db_lengths = self.lengths(db)
+        order = sorted(range(db.numstr), key=db_lengths.__getitem__)
+        self.by_length[db] = order
+        self.sorted_lengths[db] = [db_lengths[num] for num in order]
+
+    def _tables(self, tier):
+        """Returns the budget tables for tier, building them if need be."""
+        tables = self.budget_tables[tier]
+        if tables is not None:
+            return tables
+        with self.lock:
+            if self.budget_tables[tier] is not None:
+                return self.budget_tables[tier]
+            dbs, table = self.tiers[tier]
+            for db in dbs:
+                if db not in self.by_length:
+                    self._sort_lengths(db)
+            tables = []
+            for edge in self.edges:
+                prefixes = [(db, bisect.bisect_right(self.sorted_lengths[db], edge))
+                            for db in dbs]
+                prefixes = [(db, count) for db, count in prefixes if count]
+                if prefixes:
+                    tables.append((prefixes, AliasTable(
+                        [count * self.weights.get(db.name, 1.0) for db, count in prefixes],
+                        self.random_func)))
+                else:
+                    tables.append(None)
+            self.longest[tier] = max(self.sorted_lengths[db][-1] for db in dbs)
+            # Set last: other threads only look at tables once they're here.
+            self.budget_tables[tier] = tables
+            return tables
+
+    def pick_within(self, value, budget):
+        """Like pick(), but only from fortunes no longer than budget.
+
+        Returns None if no fortune in the tier fits.
+        """
+        tier = self.tier(value)
+        tables = self._tables(tier)
+        if budget >= self.longest[tier]:
+            dbs, table = self.tiers[tier]
+            db = dbs[table.draw()]
+            return db, int(self.random_func() * db.numstr)
+        edge = bisect.bisect_right(self.edges, budget) - 1
+        if edge < 0 or tables[edge] is None:
+            return None
+        prefixes, table = tables[edge]
+        db, count = prefixes[table.draw()]
+        return db, self.by_length[db][int(self.random_func() * count)]
@@ -0,0 +1,135 @@
+import Queue
+import reactor
+import threading
+import time
+import ui
+
+class PrintedEvent(ui.Event):
+    """Posted when a print job has finished.
+
+    Attributes:
+      result: What print_func returned, or None if it raised.
+      error: The exception print_func raised, or None.
+    """
+
+    def __init__(self, now, job, result=None, error=None):
+        super(PrintedEvent, self).__init__(now)
+        self.job = job
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        return "PrintedEvent(%r, %r, %r, %r)" % (
+            self.now, self.job, self.result, self.error)
+
+
+class Spooler(object):
+    """Prints jobs in order on a worker thread that owns the printer.
+
+    Arguments:
+      open_printer: Function returning the printer. It is called on the
+        worker thread, which is the only thread to use the printer after.
+      print_func: Function taking the printer and a job, which prints it and
+        may return a result, such as timing statistics.
+      max_jobs: Most jobs that may be waiting; submit() refuses more.
+      on_complete: Function called on the worker thread with a PrintedEvent
+        after each job.
+    """
+
+    def __init__(self, open_printer, print_func, max_jobs, on_complete=None,
+                 time_func=time.time):
+        self.open_printer = open_printer
+        self.print_func = print_func
+        self.on_complete = on_complete
+        self.time_func = time_func
+        self.q = Queue.Queue(max_jobs)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Waits for queued jobs to print, then stops the worker."""
+        self.q.put(None)
+        self.thread.join()
+
+    def submit(self, job):
+        """Queues a job. Raises Queue.Full if max_jobs are already waiting."""
+        self.q.put_nowait(job)
+
+    def pending(self):
+        return self.q.qsize()
+
+    def _run(self):
+        printer = self.open_printer()
+        while True:
+            job = self.q.get()
+            if job is None:
+                return
+            result = error = None
+            try:
+                result = self.print_func(printer, job)
+            except Exception as e:
+                error = e
+            if self.on_complete:
+                self.on_complete(PrintedEvent(self.time_func(), job, result, error))
+
+
+class TaskSpooler(object):
+    """Like Spooler, but prints on a reactor.Task instead of a thread.
+
+    Arguments:
+      loop: The reactor.Reactor to print on.
+      open_printer: Function returning the printer, called on the loop.
+      print_func: Generator function taking the printer and a job, which
+        prints it. It yields the seconds to wait between writes, as
+        ThermalPrinter.print_steps() does, and may finish with a result by
+        raising StopIteration(result).
+      max_jobs: Most jobs that may be waiting; submit() refuses more.
+      on_complete: Function called on the loop with a PrintedEvent after
+        each job.
+    """
+
+    def __init__(self, loop, open_printer, print_func, max_jobs, on_complete=None,
+                 time_func=time.time):
+        self.loop = loop
+        self.open_printer = open_printer
+        self.print_func = print_func
+        self.max_jobs = max_jobs
+        self.on_complete = on_complete
+        self.time_func = time_func
+        self.jobs = reactor.Channel(loop)
+        self.task = None
+
+    def start(self):
+        self.task = self.loop.spawn(self._run())
+
+    def stop(self):
+        """Runs the loop until queued jobs have printed, then stops the task."""
+        if self.task:
+            self.jobs.put(None)
+            self.loop.run(until=self.task)
+
+    def submit(self, job):
+        """Queues a job. Raises Queue.Full if max_jobs are already waiting."""
+        if len(self.jobs) >= self.max_jobs:
+            raise Queue.Full
+        self.jobs.put(job)
+
+    def pending(self):
+        return len(self.jobs)
+
+    def _run(self):
+        printer = self.open_printer()
+        while True:
+            job = yield self.jobs.get()
+            if job is None:
+                return
+            result = error = None
+            try:
+                result = yield self.loop.spawn(self.print_func(printer, job))
+            except Exception as e:
+                error = e
+            if self.on_complete:
+                self.on_complete(PrintedEvent(self.time_func(), job, result, error))
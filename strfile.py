@@ -1,33 +1,264 @@
+import array
+import collections
+import contextlib
+import mmap
+import os
 import random
+import string
 import struct
+import threading
+
+ROT13 = string.maketrans(
+    string.ascii_lowercase + string.ascii_uppercase,
+    string.ascii_lowercase[13:] + string.ascii_lowercase[:13] +
+    string.ascii_uppercase[13:] + string.ascii_uppercase[:13])
+
+class HandlePool(object):
+    """Bounds how many pooled Strfiles hold their data file open.
+
+    When a Strfile that isn't open is read, the least recently used open
+    Strfile with no read in progress is closed to make room.
+    """
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        # Open Strfiles, least recently used first, mapped to active readers.
+        self.open_files = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.opens = 0
+
+    @contextlib.contextmanager
+    def open(self, strfile):
+        with self.lock:
+            readers = self.open_files.pop(strfile, None)
+            if readers is None:
+                self._evict(self.max_open - 1)
+                strfile._open()
+                self.opens += 1
+                readers = 0
+            self.open_files[strfile] = readers + 1
+        try:
+            yield strfile
+        finally:
+            with self.lock:
+                self.open_files[strfile] -= 1
+
+    def _evict(self, keep):
+        idle = [sf for sf, readers in self.open_files.iteritems() if readers == 0]
+        for sf in idle[:max(len(self.open_files) - keep, 0)]:
+            del self.open_files[sf]
+            sf._close()
+
+    def close_all(self):
+        with self.lock:
+            self._evict(0)
+
+
+# A length index, written by mkstrfile next to the data file, holds the
+# number of printed lines in each fortune when wrapped to some width.
+LENGTHS_VERSION = 1
+LENGTHS_HEADER_FORMAT = '!LLL'
+LENGTHS_SUFFIX = '.len'
+
+def read_lengths(len_path, width):
+    """Loads a length index.
+
+    Returns:
+      An array of the printed line count of each fortune, or None if there
+      is no valid length index for width at len_path.
+    """
+    header_len = struct.calcsize(LENGTHS_HEADER_FORMAT)
+    try:
+        with open(len_path, 'rb') as fh:
+            header = fh.read(header_len)
+            table = fh.read()
+    except IOError:
+        return None
+    if len(header) < header_len:
+        return None
+    version, numstr, len_width = struct.unpack(LENGTHS_HEADER_FORMAT, header)
+    if version != LENGTHS_VERSION or len_width != width or len(table) != 2 * numstr:
+        return None
+    return array.array('H', struct.unpack('!%dH' % numstr, table))
+
 
 class Strfile(object):
     HEADER_LEN = 24
-    
-    def __init__(self, data_fh, idx_fh=None):    
+    FLAG_RANDOM = 0x1
+    FLAG_ORDERED = 0x2
+    FLAG_ROTATED = 0x4
+    # read_many() merges neighbouring fortunes into one read when the bytes
+    # between them are fewer than this.
+    MAX_GAP = 4096
+
+    def __init__(self, data_fh, idx_fh=None, use_mmap=False, pool=None):
+        """Opens a fortune database and its strfile(1) index.
+
+        The whole offset table is loaded into memory, so each fortune is cut
+        out of the data file by offset without scanning for the delimiter.
+        Each fortune ends where the next one in the file starts, which for an
+        index made with strfile -r or -o isn't the next one in the table.
+
+        Arguments:
+          data_fh: Path or file object for the fortune text.
+          idx_fh: Path or file object for the index. Defaults to data_fh + '.dat'.
+          use_mmap: If true, map the data file into memory and read fortunes by
+            slicing the map. This avoids seeking the shared file handle, so a
+            mapped Strfile may be read from several threads at once.
+          pool: A HandlePool. If given, data_fh and idx_fh must be paths, and
+            only the index header is read here; the files are opened on first
+            read and may be closed again by the pool.
+        """
         if idx_fh is None:
             idx_fh = data_fh + ".dat"
-        if isinstance(data_fh, basestring):
-            data_fh = open(data_fh, 'r')
-        self.data_fh = data_fh
-        if isinstance(idx_fh, basestring):
-            idx_fh = open(idx_fh, 'r')
-        self.idx_fh = idx_fh
+        self.data_path = getattr(data_fh, 'name', data_fh)
+        self.idx_path = getattr(idx_fh, 'name', idx_fh)
+        self.name = os.path.basename(self.data_path)
+        self.use_mmap = use_mmap
+        self.pool = pool
+        self.data_fh = None
+        self.idx_fh = None
+        self.data_map = None
+        self.offsets = None
+        self.ends = None
+        if pool is None:
+            self._open(data_fh, idx_fh)
+        else:
+            with open(idx_fh, 'r') as fh:
+                self._read_header(fh)
+
+    def _read_header(self, idx_fh):
         self.version, self.numstr, self.longlen, self.shortlen, self.flags, \
           self.delim = struct.unpack('!LLLLLc', idx_fh.read(self.HEADER_LEN - 3))
-    
+
+    def _open(self, data_fh=None, idx_fh=None):
+        if data_fh is None:
+            data_fh = open(self.data_path, 'r')
+        elif isinstance(data_fh, basestring):
+            data_fh = open(data_fh, 'r')
+        self.data_fh = data_fh
+        if self.offsets is None:
+            if idx_fh is None:
+                with open(self.idx_path, 'r') as fh:
+                    self._read_header(fh)
+                    self.offsets = self._read_offsets(fh)
+            else:
+                if isinstance(idx_fh, basestring):
+                    idx_fh = open(idx_fh, 'r')
+                self.idx_fh = idx_fh
+                self._read_header(idx_fh)
+                self.offsets = self._read_offsets(idx_fh)
+            self.ends = self._find_ends(self.offsets)
+        if self.use_mmap:
+            self.data_map = mmap.mmap(data_fh.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.pool is not None:
+                # The map holds its own descriptor.
+                self.data_fh.close()
+                self.data_fh = None
+
+    def _close(self):
+        if self.data_map is not None:
+            self.data_map.close()
+            self.data_map = None
+        if self.data_fh is not None:
+            self.data_fh.close()
+            self.data_fh = None
+
+    def _read_offsets(self, idx_fh):
+        idx_fh.seek(self.HEADER_LEN)
+        table = idx_fh.read(4 * (self.numstr + 1))
+        count = len(table) // 4
+        offsets = array.array('L', struct.unpack('!%dL' % count, table[:4 * count]))
+        if count == self.numstr:
+            # No trailing end-of-file offset; the last fortune runs to EOF.
+            offsets.append(os.fstat(self.data_fh.fileno()).st_size)
+        return offsets
+
+    def _find_ends(self, offsets):
+        """Returns the offset each fortune ends at, by fortune number."""
+        if not self.flags & (self.FLAG_RANDOM | self.FLAG_ORDERED):
+            return offsets[1:]
+        # The table is shuffled or sorted, so find each fortune's successor
+        # in the file. The end-of-file offset stays last in the table.
+        in_file_order = sorted(offsets[:self.numstr])
+        in_file_order.append(offsets[self.numstr])
+        following = dict(zip(in_file_order, in_file_order[1:]))
+        return array.array('L', (following[offset] for offset in offsets[:self.numstr]))
+
+    def _read_range(self, start, end):
+        if self.use_mmap:
+            return self.data_map[start:end]
+        self.data_fh.seek(start)
+        return self.data_fh.read(end - start)
+
+    def _decode(self, block):
+        if self.flags & self.FLAG_ROTATED:
+            return block.translate(ROT13)
+        return block
+
+    def _split(self, block):
+        lines = block.splitlines(True)
+        while lines and lines[-1].strip() == self.delim:
+            lines.pop()
+        return lines
+
     def read(self, num):
-        self.idx_fh.seek(self.HEADER_LEN + 4 * num)
-        offset = struct.unpack('!L', self.idx_fh.read(4))[0]
-        self.data_fh.seek(offset)
-        ret = []
-        while True:
-            line = self.data_fh.readline()
-            if self.flags & 0x4:
-                line = line.decode('rot13')
-            if line.strip() == self.delim or line == '':
-                return ret
-            ret.append(line)
+        return self.decode(self.read_raw(num))
+
+    def read_raw(self, num):
+        """Returns fortune number num as stored, before decode()."""
+        if self.pool is not None:
+            with self.pool.open(self):
+                return self._read_range(self.offsets[num], self.ends[num])
+        return self._read_range(self.offsets[num], self.ends[num])
+
+    def decode(self, block):
+        """Turns a block from read_raw() into a list of lines."""
+        return self._split(self._decode(block))
+
+    def read_many(self, indices):
+        """Reads several fortunes in one pass over the data file.
+
+        Arguments:
+          indices: Fortune numbers, in any order and possibly repeated.
+        Returns:
+          A list of fortunes, each a list of lines, in the order of indices.
+        """
+        if self.pool is not None:
+            with self.pool.open(self):
+                return self._read_many(indices)
+        return self._read_many(indices)
+
+    def _read_many(self, indices):
+        offsets = self.offsets
+        fortunes = {}
+        run = []
+        for num in sorted(set(indices), key=offsets.__getitem__):
+            if run and offsets[num] - self.ends[run[-1]] > self.MAX_GAP:
+                self._read_run(run, fortunes)
+                run = []
+            run.append(num)
+        if run:
+            self._read_run(run, fortunes)
+        return [fortunes[num] for num in indices]
+
+    def _read_run(self, nums, fortunes):
+        offsets = self.offsets
+        base = offsets[nums[0]]
+        block = self._decode(self._read_range(base, self.ends[nums[-1]]))
+        for num in nums:
+            fortunes[num] = self._split(
+                block[offsets[num] - base:self.ends[num] - base])
 
     def read_random(self):
         return self.read(random.randrange(self.numstr))
+
+    def read_lengths(self, width):
+        """Returns the length index for this database, as read_lengths() does.
+
+        Returns None too if the index doesn't cover every fortune.
+        """
+        lengths = read_lengths(self.data_path + LENGTHS_SUFFIX, width)
+        if lengths is None or len(lengths) != self.numstr:
+            return None
+        return lengths
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+
+import coin
+import gpioedge
+import hwsim
+import ui
+
+class CoinPulseDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = coin.CoinPulseDecoder(True, range(1, 7), 0.005, 0.15, 0.005, 0.1)
+        self.source = gpioedge.SimulatedEdgeSource(self.decoder, True)
+
+    def decode(self, end):
+        return list(self.decoder(end + 1.0))
+
+    def test_pulse_train(self):
+        end = self.source.pulse_train(3, 0.03, 0.05, False, start=10.0)
+        events = self.decode(end)
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], ui.InputEvent)
+        self.assertEqual(events[0].state, 3)
+
+    def test_glitch_before_train(self):
+        # A 1ms spike ending 3ms before the coin's first pulse.
+        self.source.pulse_train(1, 0.001, 0, False, start=10.0)
+        end = self.source.pulse_train(3, 0.03, 0.05, False, start=10.004)
+        events = self.decode(end)
+        self.assertEqual([(type(event), event.state) for event in events],
+                         [(ui.InputEvent, 3)])
+        self.assertEqual(self.decoder.counters['glitches'], 1)
+        self.assertEqual(self.decoder.counters['short_gaps'], 0)
+
+    def test_glitch_within_train(self):
+        self.source.pulse_train(2, 0.03, 0.05, False, start=10.0)
+        self.source.pulse_train(1, 0.001, 0, False, start=10.112)
+        end = self.source.pulse_train(1, 0.03, 0.05, False, start=10.16)
+        events = self.decode(end)
+        self.assertEqual([(type(event), event.state) for event in events],
+                         [(ui.InputEvent, 3)])
+
+    def test_short_gap(self):
+        self.source.pulse_train(1, 0.03, 0, False, start=10.0)
+        end = self.source.pulse_train(2, 0.03, 0.05, False, start=10.032)
+        events = self.decode(end)
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], coin.RejectedCoinEvent)
+        self.assertEqual(events[0].reason, 'short gap')
+
+    def test_noise_alone(self):
+        end = self.source.pulse_train(2, 0.001, 0.05, False, start=10.0)
+        self.assertEqual(self.decode(end), [])
+        self.assertEqual(self.decoder.counters['glitches'], 2)
+        self.assertIsNone(self.decoder.next_poll(end + 1.0))
+
+    def test_missed_pulse(self):
+        self.source.pulse_train(2, 0.03, 0.05, False, start=10.0)
+        self.source.miss(10.16)
+        end = self.source.pulse_train(1, 0.03, 0.05, False, start=10.24)
+        events = self.decode(end)
+        self.assertEqual([(type(event), event.reason) for event in events],
+                         [(coin.RejectedCoinEvent, 'missed edge')])
+        self.assertEqual(self.decoder.counters['missed_edges'], 1)
+
+
+class RPiEdgeSourceTest(unittest.TestCase):
+    def test_pulse_over_before_read(self):
+        gpio = hwsim.GPIO(sleep_func=lambda seconds: None)
+        gpio.setup(26, gpio.IN, pull_up_down=gpio.PUD_UP)
+        decoder = coin.CoinPulseDecoder(True, range(1, 7), 0.005, 0.15, 0.005, 0.1)
+        source = gpioedge.RPiEdgeSource(gpio, 26, decoder, True)
+        # Hold up the callback thread until the pulse is over, so both of
+        # its callbacks read the pin high.
+        gate = threading.Event()
+        done = threading.Event()
+        gpio.edges.put((lambda pin: gate.wait(), 26))
+        gpio.pulse_train(26, 1, 0.03, 0.05)
+        gpio.edges.put((lambda pin: done.set(), 26))
+        gate.set()
+        done.wait(5.0)
+        self.assertEqual(source.missed, 2)
+        events = list(decoder(time.time() + 1.0))
+        self.assertEqual([(type(event), event.reason) for event in events],
+                         [(coin.RejectedCoinEvent, 'missed edge')])
+
+
+if __name__ == '__main__':
+    unittest.main()
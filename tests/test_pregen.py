@@ -0,0 +1,38 @@
+import time
+import unittest
+
+import pregen
+
+class PregeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.pregenerator = pregen.Pregenerator(lambda value: ('receipt', value))
+        self.pregenerator.start()
+
+    def tearDown(self):
+        self.pregenerator.stop()
+
+    def wait_ready(self, values):
+        for i in range(100):
+            with self.pregenerator.cond:
+                if set(self.pregenerator.ready) == set(values):
+                    return
+            time.sleep(0.01)
+        self.fail('never ready: %r' % (values,))
+
+    def test_results_only_for_their_value(self):
+        self.pregenerator.prepare([100, 200, 500])
+        self.wait_ready([100, 200, 500])
+        self.assertEqual(self.pregenerator.take(500), ('receipt', 500))
+        self.assertEqual(self.pregenerator.take(100), ('receipt', 100))
+        self.assertEqual(self.pregenerator.take(300), ('receipt', 300))
+        self.assertEqual((self.pregenerator.hits, self.pregenerator.misses), (2, 1))
+
+    def test_prepare_drops_other_values(self):
+        self.pregenerator.prepare([100, 200])
+        self.wait_ready([100, 200])
+        self.pregenerator.prepare([200, 250])
+        self.wait_ready([200, 250])
+
+
+if __name__ == '__main__':
+    unittest.main()
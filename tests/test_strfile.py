@@ -0,0 +1,66 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mkstrfile
+import strfile
+
+FORTUNES = ['Fortune number %d.\nIt has %s.\n' % (i, 'line ' * (i % 7)) for i in range(40)]
+
+class StrfileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.dir, 'riddles')
+        with open(self.data_path, 'w') as fh:
+            fh.write('%\n'.join(FORTUNES))
+        self.index = mkstrfile.build(self.data_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reorder(self, flag, key):
+        """Rewrites the index as strfile -r or -o would, returning the new order."""
+        order = sorted(range(len(FORTUNES)), key=key)
+        offsets = self.index.offsets
+        self.index.offsets = type(offsets)('L', [offsets[i] for i in order] + [offsets[-1]])
+        self.index.flags |= flag
+        self.index.save(self.data_path + '.dat')
+        return order
+
+    def check(self, order, **kwargs):
+        db = strfile.Strfile(self.data_path, **kwargs)
+        expected = [FORTUNES[i].splitlines(True) for i in order]
+        self.assertEqual([db.read(num) for num in range(db.numstr)], expected)
+        nums = [5, 0, 39, 17, 5, 22]
+        self.assertEqual(db.read_many(nums), [expected[num] for num in nums])
+
+    def test_in_order(self):
+        self.check(range(len(FORTUNES)))
+        self.check(range(len(FORTUNES)), use_mmap=True)
+
+    def test_randomized(self):
+        rng = random.Random(1)
+        keys = [rng.random() for fortune in FORTUNES]
+        order = self.reorder(strfile.Strfile.FLAG_RANDOM, keys.__getitem__)
+        self.check(order)
+        self.check(order, use_mmap=True, pool=strfile.HandlePool(1))
+
+    def test_ordered(self):
+        order = self.reorder(strfile.Strfile.FLAG_ORDERED, lambda i: FORTUNES[i][-9:])
+        self.check(order)
+
+    def test_update_rebuilds_randomized(self):
+        self.reorder(strfile.Strfile.FLAG_RANDOM, lambda i: -i)
+        with open(self.data_path, 'a') as fh:
+            fh.write('%\nOne more.\n')
+        index = mkstrfile.update(self.data_path)
+        self.assertFalse(index.flags & strfile.Strfile.FLAG_RANDOM)
+        db = strfile.Strfile(self.data_path)
+        self.assertEqual(db.read(0), FORTUNES[0].splitlines(True))
+        self.assertEqual(db.read(40), ['One more.\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+import gpioedge
+import hwsim
+import ui
+
+class EdgeInputHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.woken = []
+        self.handler = ui.EdgeInputHandler('red', True, lambda: self.woken.append(True))
+        self.source = gpioedge.SimulatedEdgeSource(self.handler, True)
+
+    def test_idle(self):
+        self.assertEqual(self.handler.next_poll(10.0), None)
+        self.assertEqual(list(self.handler(10.0)), [])
+
+    def test_press_and_release(self):
+        self.source.set(False, 10.0)
+        self.source.set(True, 10.2)
+        self.assertEqual(len(self.woken), 2)
+        self.assertEqual(self.handler.next_poll(10.3), 0)
+        events = list(self.handler(10.3))
+        self.assertEqual([(event.now, event.state, event.args) for event in events],
+                         [(10.0, False, 'red'), (10.2, True, 'red')])
+        self.assertEqual(self.handler.next_poll(10.3), None)
+
+    def test_repeated_state(self):
+        self.handler.edge(10.0, False)
+        self.handler.edge(10.1, False)
+        self.assertEqual([event.state for event in self.handler(10.2)], [False])
+        self.assertEqual(len(self.woken), 1)
+
+    def test_resample_after_bounce(self):
+        gpio = hwsim.GPIO(sleep_func=lambda seconds: None)
+        gpio.setup(16, gpio.IN, pull_up_down=gpio.PUD_UP)
+        handler = ui.EdgeInputHandler('black', True, settle_time=0.02)
+        source = gpioedge.RPiEdgeSource(gpio, 16, handler, True, 20,
+                                        time_func=lambda: 10.0)
+        handler.resample = source.resample
+        gpio.set(16, False)
+        done = threading.Event()
+        gpio.edges.put((lambda pin: done.set(), 16))
+        done.wait(5.0)
+        self.assertEqual([event.state for event in handler(10.0)], [False])
+        self.assertAlmostEqual(handler.next_poll(10.0), 0.02)
+        # The release comes within bouncetime, so RPi.GPIO ignores it.
+        gpio.remove_event_detect(16)
+        gpio.set(16, True)
+        self.assertEqual([event.state for event in handler(10.01)], [])
+        self.assertEqual([(event.now, event.state) for event in handler(10.02)],
+                         [(10.02, True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
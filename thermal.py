@@ -0,0 +1,121 @@
+import collections
+import time
+
+class PrintStats(object):
+    """Timing for one receipt.
+
+    Attributes:
+      bytes: Number of bytes written.
+      elapsed: Seconds from the first write until the last byte was sent.
+      bytes_per_second: bytes / elapsed.
+    """
+
+    def __init__(self, bytes, elapsed):
+        self.bytes = bytes
+        self.elapsed = elapsed
+        self.bytes_per_second = bytes / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return "PrintStats(%d bytes, %.3fs, %.0f bytes/s)" % (
+            self.bytes, self.elapsed, self.bytes_per_second)
+
+
+class ThermalPrinter(object):
+    """Writes receipts to a serial thermal printer as fast as it can print them.
+
+    The printer is modelled as taking 1 / bytes_per_second for each byte it
+    receives plus line_time for each line it prints. Lines are sent in
+    chunks of up to chunk_size bytes, and a chunk is held back until the
+    model says the printer has room for it in its buffer_size byte buffer.
+
+    Arguments:
+      port: An open serial.Serial.
+      bytes_per_second: Defaults to the port's baud rate / 10.
+      line_time: Seconds the printer takes to heat and feed one line.
+      buffer_size: Size of the printer's receive buffer, in bytes.
+      chunk_size: Largest single write, in bytes.
+    """
+    UPSIDE_DOWN = '\x1B{1'
+
+    def __init__(self, port, bytes_per_second=None, line_time=0.1,
+                 buffer_size=256, chunk_size=64,
+                 sleep_func=time.sleep, time_func=time.time):
+        self.port = port
+        if bytes_per_second is None:
+            bytes_per_second = port.baudrate / 10.0
+        self.bytes_per_second = bytes_per_second
+        self.line_time = line_time
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.sleep_func = sleep_func
+        self.time_func = time_func
+        self.last_stats = None
+        # (time the printer will have printed it, size) for each chunk sent.
+        self.in_flight = collections.deque()
+        self.ready_at = 0
+        # When the port will have sent everything written to it.
+        self.sent_at = 0
+        port.write(self.UPSIDE_DOWN)
+
+    def _chunks(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) > self.chunk_size:
+                yield ''.join(chunk), len(chunk)
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line)
+        if chunk:
+            yield ''.join(chunk), len(chunk)
+
+    def _time_until_room(self, size, now):
+        """Returns how long until the printer has room for size more bytes."""
+        in_flight = self.in_flight
+        while in_flight and in_flight[0][0] <= now:
+            in_flight.popleft()
+        backlog = sum(n for _, n in in_flight)
+        if not in_flight or backlog + size <= self.buffer_size:
+            return 0
+        return in_flight[0][0] - now
+
+    def print_lines(self, lines):
+        """Prints lines upside down, so the last line is printed first.
+
+        Arguments:
+          lines: Each is one printed line; lines of full printer width need
+            no newline.
+        Returns:
+          A PrintStats for the receipt.
+        """
+        for delay in self.print_steps(lines):
+            self.sleep_func(delay)
+        return self.last_stats
+
+    def print_steps(self, lines):
+        """Like print_lines(), but yields the seconds to wait instead of sleeping.
+
+        This lets a reactor.Task print without blocking its loop. The
+        PrintStats is left in last_stats.
+        """
+        start = self.time_func()
+        total = 0
+        for data, num_lines in self._chunks(lines[::-1]):
+            while True:
+                delay = self._time_until_room(len(data), self.time_func())
+                if not delay:
+                    break
+                yield delay
+            self.port.write(data)
+            total += len(data)
+            now = self.time_func()
+            self.sent_at = max(self.sent_at, now) + len(data) / self.bytes_per_second
+            self.ready_at = max(self.ready_at, now) + (
+                len(data) / self.bytes_per_second + num_lines * self.line_time)
+            self.in_flight.append((self.ready_at, len(data)))
+        delay = self.sent_at - self.time_func()
+        if delay > 0:
+            yield delay
+        self.port.flush()
+        self.last_stats = PrintStats(total, self.time_func() - start)
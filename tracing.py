@@ -0,0 +1,132 @@
+"""Lightweight tracing of timed stages into an in-memory ring buffer."""
+
+import collections
+import contextlib
+import fcntl
+import itertools
+import os
+import select
+import signal
+import threading
+import time
+
+Span = collections.namedtuple('Span', 'trace_id name thread start end attrs')
+
+class Tracer(object):
+    """Records how long each stage of a piece of work took.
+
+    Work is grouped into traces by a trace id, which follows the thread: spans
+    opened inside trace() belong to it. To continue a trace on another
+    thread, pass its id along with the work and call trace(trace_id) there.
+    Only the most recent size spans are kept.
+
+    Arguments:
+      size: Number of spans to keep.
+      time_func: Clock for span start and end times.
+    """
+
+    def __init__(self, size=1024, time_func=time.time):
+        self.spans = collections.deque(maxlen=size)
+        self.time_func = time_func
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.dumps = 0
+
+    def current(self):
+        """Returns the id of the trace open on this thread, or None."""
+        return getattr(self.local, 'trace_id', None)
+
+    @contextlib.contextmanager
+    def trace(self, trace_id=None):
+        """Makes trace_id the current trace for this thread, and yields it.
+
+        With no trace_id, the current trace is kept if there is one, and a
+        new trace is started otherwise.
+        """
+        previous = self.current()
+        if trace_id is None:
+            trace_id = previous or next(self.ids)
+        self.local.trace_id = trace_id
+        try:
+            yield trace_id
+        finally:
+            self.local.trace_id = previous
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Times the body as a stage of the current trace.
+
+        Yields the span's attribute dict, so results can be added to it.
+        """
+        start = self.time_func()
+        try:
+            yield attrs
+        finally:
+            self.record(self.current(), name, start, self.time_func(), attrs)
+
+    def record(self, trace_id, name, start, end, attrs):
+        """Adds a span timed by the caller.
+
+        For work that can't be inside span(), such as a reactor task, which
+        shares its thread, and so its current trace, with other tasks.
+        """
+        # deque.append is atomic, so no lock is needed.
+        self.spans.append(Span(trace_id, name, threading.current_thread().name,
+                               start, end, attrs))
+
+    def dump(self, fh):
+        """Writes the buffered spans to fh, grouped by trace, oldest first."""
+        spans = sorted(list(self.spans), key=lambda span: (span.trace_id, span.start))
+        trace_id = trace_start = None
+        for span in spans:
+            if span.trace_id != trace_id or trace_id is None:
+                trace_id, trace_start = span.trace_id, span.start
+                fh.write('trace %s at %s.%03d\n' % (
+                    trace_id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(span.start)),
+                    int(span.start * 1000) % 1000))
+            fh.write('  %+10.3fms %10.3fms  %-12s %-16s %s\n' % (
+                (span.start - trace_start) * 1000, (span.end - span.start) * 1000,
+                span.thread, span.name,
+                ' '.join('%s=%s' % item for item in sorted(span.attrs.items()))))
+        self.dumps += 1
+
+    def dump_to(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            self.dump(fh)
+        os.rename(tmp_path, path)
+
+    def dump_on_signal(self, signum, path):
+        """Dumps the spans to path whenever the process receives signum.
+
+        Python runs signal handlers on the main thread, in the middle of
+        whatever it was doing, such as running the reactor. So the handler
+        only wakes a separate thread, which sorts and writes the spans
+        without holding up the main thread or raising into it. Must be
+        called from the main thread.
+        """
+        read_fd, write_fd = os.pipe()
+        for fd in read_fd, write_fd:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        def handler(signum, frame):
+            try:
+                os.write(write_fd, 'x')
+            except OSError:
+                # A full pipe means a dump is due anyway.
+                pass
+        signal.signal(signum, handler)
+        thread = threading.Thread(target=self._dump_thread, args=(read_fd, path))
+        thread.daemon = True
+        thread.start()
+
+    def _dump_thread(self, read_fd, path):
+        while True:
+            select.select([read_fd], [], [])
+            try:
+                os.read(read_fd, 512)
+            except OSError:
+                continue
+            try:
+                self.dump_to(path)
+            except (IOError, OSError):
+                pass
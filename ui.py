@@ -1,17 +1,67 @@
+import collections
+import math
+import os
 import Queue
+import select
 import threading
 import time
 
+INFINITY = float('inf')
+
+class JitterStats(object):
+    """Running count, mean, standard deviation and maximum of poll lateness."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.max = 0.0
+        self._m2 = 0.0
+
+    def add(self, lateness):
+        self.count += 1
+        delta = lateness - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (lateness - self.mean)
+        self.max = max(self.max, lateness)
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def __repr__(self):
+        return "JitterStats(count=%d, mean=%.6f, stddev=%.6f, max=%.6f)" % (
+            self.count, self.mean, self.stddev, self.max)
+
+
 class UIEventGenerator(object):
-    def __init__(self, poll_interval, poll_functions, sleep_func=time.sleep, time_func=time.time):
+    """Polls input handlers on a thread and queues the events they produce.
+
+    Each handler is polled on its own schedule. A handler with a next_poll()
+    method returns the seconds until it next wants polling, or None if it
+    has nothing to do until an edge source calls wake(); other handlers are
+    polled every poll_interval. The thread sleeps until the earliest
+    deadline, but never longer than idle_interval. How late each scheduled
+    poll runs is recorded in jitter.
+    """
+
+    def __init__(self, poll_interval, poll_functions, sleep_func=None, time_func=time.time,
+                 idle_interval=1.0):
         self.poll_interval = poll_interval
         self.poll_functions = poll_functions
+        if sleep_func is None:
+            sleep_func = self._wait
         self.sleep_func = sleep_func
         self.time_func = time_func
+        self.idle_interval = idle_interval
 
         self.q = Queue.Queue()
         self.ui_thread = threading.Thread(target=self._ui_thread)
         self.ui_thread.daemon = True
+        self._wake_r, self._wake_w = os.pipe()
+        self.deadlines = {}
+        self.jitter = JitterStats()
     
     def start(self):
         self._stop = False
@@ -19,21 +69,83 @@ class UIEventGenerator(object):
      
     def stop(self):
         self._stop = True
+        self.wake()
         self.ui_thread.join()
     
     def __iter__(self):
         return self
     
     def next(self):
-        return self.q.get()
+        # Python 2 can't interrupt a get() without a timeout, so a signal's
+        # handler would wait for the next event.
+        while True:
+            try:
+                return self.q.get(timeout=1.0)
+            except Queue.Empty:
+                pass
+
+    def post(self, event):
+        """Adds an event from outside the polling thread."""
+        self.q.put(event)
+
+    def wake(self):
+        """Makes the polling thread poll now. Safe to call from any thread."""
+        os.write(self._wake_w, 'x')
+
+    def fileno(self):
+        """Returns a descriptor that is readable after wake().
+
+        With it, an event loop can run poll() instead of the polling thread.
+        """
+        return self._wake_r
+
+    def clear_wake(self):
+        os.read(self._wake_r, 512)
+
+    def _wait(self, timeout):
+        if select.select([self._wake_r], [], [], timeout)[0]:
+            self.clear_wake()
     
+    def _next_poll(self, func, now):
+        if hasattr(func, 'next_poll'):
+            return func.next_poll(now)
+        return self.poll_interval
+
+    def poll(self, now, emit):
+        """Polls the handlers that are due at time now, passing their events to emit.
+
+        Returns:
+          When a handler is next due, but no later than idle_interval from now.
+        """
+        deadlines = self.deadlines
+        wake_at = now + self.idle_interval
+        for func in self.poll_functions:
+            due = deadlines.get(func, now)
+            interval = self._next_poll(func, now)
+            if interval is not None:
+                # A handler may want polling sooner after an edge.
+                due = min(due, now + interval)
+            if due <= now:
+                if func in deadlines:
+                    self.jitter.add(now - due)
+                for event in func(now):
+                    emit(event)
+                interval = self._next_poll(func, now)
+                if interval is None:
+                    due = INFINITY
+                elif due + interval > now:
+                    # Keep to the schedule however long polling took.
+                    due += interval
+                else:
+                    due = now + interval
+            deadlines[func] = due
+            wake_at = min(wake_at, due)
+        return wake_at
+
     def _ui_thread(self):
         while not self._stop:
-            now = self.time_func()
-            for func in self.poll_functions:
-                for event in func(now):
-                    self.q.put(event)
-            self.sleep_func(self.poll_interval)
+            wake_at = self.poll(self.time_func(), self.q.put)
+            self.sleep_func(max(wake_at - self.time_func(), 0))
 
             
 class Event(object):
@@ -52,35 +164,133 @@ class InputEvent(Event):
 
         
 class InputEventHandler(object):
-    def __init__(self, status_func, args):
+    """Polls an input, producing an event when it changes.
+
+    The input is polled every poll_interval for active_time seconds after a
+    change, and every idle_interval (default: poll_interval) otherwise.
+    """
+
+    def __init__(self, status_func, args, poll_interval=0.01, idle_interval=None,
+                 active_time=1.0):
         self.status_func = status_func
         self.args = args
         self.current_state = status_func()
+        self.poll_interval = poll_interval
+        self.idle_interval = idle_interval
+        self.active_time = active_time
+        self.last_change = None
     
     def __call__(self, now):
         state = self.status_func()
         if state != self.current_state:
             yield InputEvent(now, state, self.args)
             self.current_state = state
+            self.last_change = now
+
+    def next_poll(self, now):
+        if self.idle_interval is None or (
+                self.last_change is not None and now - self.last_change < self.active_time):
+            return self.poll_interval
+        return self.idle_interval
+
+
+class EdgeInputHandler(object):
+    """Like InputEventHandler, but told about changes instead of polling.
+
+    An edge source calls edge() from its own thread; events keep the time of
+    the edge and are handed to the UIEventGenerator on its next poll, which
+    wake() triggers straight away.
+
+    With settle_time set, the handler calls resample(now) that many seconds
+    after the last edge, so a source that drops edges while a button
+    bounces can report where it settled.
+    """
+
+    def __init__(self, args, initial_state, wake=None, settle_time=None, resample=None):
+        self.args = args
+        self.current_state = initial_state
+        self.wake = wake
+        self.settle_time = settle_time
+        self.resample = resample
+        self.settle_at = None
+        self.pending = collections.deque()
+
+    def edge(self, now, state):
+        if state != self.current_state:
+            self.current_state = state
+            self.pending.append(InputEvent(now, state, self.args))
+            if self.wake:
+                self.wake()
+        self._settle(now)
+
+    def missed(self, now):
+        # Nothing was seen to change, but the pin may not have settled.
+        self._settle(now)
+
+    def _settle(self, now):
+        if self.settle_time and self.resample:
+            self.settle_at = now + self.settle_time
+            if self.wake:
+                self.wake()
+
+    def __call__(self, now):
+        if self.settle_at is not None and now >= self.settle_at:
+            self.settle_at = None
+            self.resample(now)
+        while self.pending:
+            yield self.pending.popleft()
+
+    def next_poll(self, now):
+        if self.pending:
+            return 0
+        if self.settle_at is not None:
+            return max(self.settle_at - now, 0)
+        return None
 
             
 class MultiPulseEventHandler(object):
+    """Counts pulses on an input, producing an event after each train.
+
+    The input is polled every poll_interval, and every active_interval
+    (default: poll_interval) while a train is in progress.
+    """
     IDLE = 1
     PULSE = 2
     WAITING = 3
     
-    def __init__(self, status_func, default_state, interpulse_delay, args):
+    def __init__(self, status_func, default_state, interpulse_delay, args,
+                 poll_interval=0.01, active_interval=None):
         self.status_func = status_func
         self.default_input_state = default_state
         self.interpulse_delay = interpulse_delay
         self.args = args
+        self.poll_interval = poll_interval
+        self.active_interval = active_interval
         
         self.last_event = None
         self.pulse_count = 0
         self.state = self.IDLE
     
     def __call__(self, now):
-        state = self.status_func()
+        event = self._step(now, self.status_func())
+        if event:
+            yield event
+
+    def _train_end(self, now):
+        """Seconds until a train that is WAITING would end."""
+        return max(self.last_event + self.interpulse_delay - now, 0)
+
+    def next_poll(self, now):
+        if self.state == self.IDLE or self.active_interval is None:
+            interval = self.poll_interval
+        else:
+            interval = self.active_interval
+        if self.state == self.WAITING:
+            interval = min(interval, self._train_end(now))
+        return interval
+
+    def _step(self, now, state):
+        """Advances the pulse counter. Returns an InputEvent when a train ends."""
         if self.state == self.IDLE:
             if state != self.default_input_state:
                 self.state = self.PULSE
@@ -96,15 +306,18 @@ class MultiPulseEventHandler(object):
                 self.pulse_count += 1
                 self.last_event = now
             elif now > self.last_event + self.interpulse_delay:
-                yield InputEvent(now, self.pulse_count, self.args)
                 self.state = self.IDLE
                 self.last_event = now
+                return InputEvent(now, self.pulse_count, self.args)
+        return None
+
 
 class TimeoutEvent(Event): pass
                 
 class TimeoutEventHandler(object):
-    def __init__(self):
+    def __init__(self, wake=None):
         self.timeout_at = None
+        self.wake = wake
         
     def __call__(self, now):
         if self.timeout_at and now > self.timeout_at:
@@ -113,3 +326,10 @@ class TimeoutEventHandler(object):
     
     def set_timeout(self, delay):
         self.timeout_at = time.time() + delay
+        if self.wake:
+            self.wake()
+
+    def next_poll(self, now):
+        if self.timeout_at is None:
+            return None
+        return max(self.timeout_at - now, 0)
@@ -0,0 +1,64 @@
+"""Unwrapping fortunes into paragraphs, and wrapping them for printing."""
+
+def unwrap(lines):
+    """Takes line wrapped text and 'unwraps' it.
+    
+    Arguments:
+      lines: A list of lines in the original text, optionally newline terminated.
+    Returns:
+      A list of paragraphs, not newline terminated.
+    """
+    if not lines:
+        return lines
+    paras = []
+    current = [lines[0].strip()]
+    for line in lines[1:]:
+        if line.startswith('\t') or line.startswith('<'):
+            # Indent or symbol means a mandatory linebreak
+            paras.append(' '.join(current))
+            current = [line.strip()]
+        else:
+            # Append to current line
+            current.append(line.strip())
+    paras.append(' '.join(current))
+    return paras
+
+def _wrap_para(para, maxlen, lines):
+    """Appends the lines of para wrapped to maxlen, and a blank line, to lines.
+
+    A line of exactly maxlen is not newline terminated, as the printer
+    wraps it by itself. A word longer than maxlen is split, losing the
+    character at the split.
+    """
+    start = 0
+    end = len(para)
+    while end - start > maxlen:
+        lastbreak = para.rfind(' ', start, start + maxlen + 1)
+        if lastbreak == -1:
+            lastbreak = start + maxlen
+        if lastbreak == start + maxlen:
+            lines.append(para[start:lastbreak])
+        else:
+            lines.append(para[start:lastbreak] + '\n')
+        start = lastbreak + 1
+    rest = para[start:] if start else para
+    if len(rest) == maxlen:
+        lines.append(rest)
+    elif rest.strip():
+        lines.append(rest + '\n')
+    lines.append('\n')
+
+def wrap(paras, maxlen=32):
+    """Line wraps a set of paragraphs.
+    
+    Arguments:
+      paras: A list of paragraph strings, not newline terminated.
+      maxlen: Length to wrap at.
+    Returns:
+      A list of line strings each no longer than maxlen, newline
+      terminated. Each paragraph is separated by a blank line.
+    """
+    lines = []
+    for para in paras:
+        _wrap_para(para, maxlen, lines)
+    return lines